@@ -0,0 +1,105 @@
+# client of generation server, takes the same arguments as generator.py
+#   python generator.py --serve [SOCKET]           (once: libclang, handled files and resolved types are kept warm)
+#   python client.py -s settings.json [...]         (instead of: python generator.py -s settings.json [...])
+#   python client.py --stop-server
+# if server isn't running, generation is done in this process
+
+
+import os
+import sys
+import json
+import stat
+import struct
+import socket
+import argparse
+import tempfile
+
+
+def get_default_socket():
+    # socket is kept in directory only current user has access to, so nobody else can stand up server there
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "code-generator.sock")
+
+    directory = os.path.join(tempfile.gettempdir(), "code-generator-{}".format(os.getuid()))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError("{} isn't private directory of current user".format(directory))
+    return os.path.join(directory, "server.sock")
+
+
+def check_owner(socket_path):
+    # socket created by another user is never used (nor removed as stale one)
+    if os.lstat(socket_path).st_uid != os.getuid():
+        raise PermissionError("{} is owned by another user".format(socket_path))
+
+
+def check_peer(connection):
+    # server process must be run by current user as well, where it can be checked
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", credentials)
+    if uid != os.getuid():
+        raise PermissionError("server on {} is run by another user".format(connection.getpeername()))
+
+
+def send_message(stream, message):
+    # message = one line of json
+    stream.write(json.dumps(message).encode() + b"\n")
+    stream.flush()
+
+
+def receive_message(stream):
+    line = stream.readline()
+    return json.loads(line) if line else None
+
+
+def request(socket_path, message):
+    check_owner(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        check_peer(connection)
+        with connection.makefile(mode="rwb") as stream:
+            send_message(stream, message)
+            return receive_message(stream)
+
+
+def parse_args():
+    # options of client itself, all the others are passed to generator
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--socket', dest="socket", type=str, default=None, help="unix socket server accepts on")
+    parser.add_argument('--stop-server', dest="stop", action="store_true", help="stop server and exit")
+    return parser.parse_known_args()
+
+
+def main():
+    args, generator_args = parse_args()
+    message = {"stop": True} if args.stop else {"args": generator_args, "cwd": os.getcwd()}
+
+    try:
+        socket_path = args.socket or get_default_socket()
+        response = request(socket_path, message)
+    except PermissionError as error:
+        print(":: {}".format(error))
+        sys.exit(1)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if args.stop:
+            print(":: Server isn't running on {}".format(socket_path))
+            return
+        print(":: Server isn't running on {}, generating in this process".format(socket_path))
+        sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "generator.py")] + generator_args
+        import generator
+        generator.main()
+        return
+
+    if response is None:
+        print(":: Server closed connection without response")
+        sys.exit(1)
+    sys.stdout.write(response["log"])
+    sys.exit(response["status"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,15 @@
-from modules import Kinds, Writer, Parser
+from modules import Kinds, CommonTypeData, Writer, Parser, ExtractionCache, MemoryCache, walk, profiler
 from clang.cindex import Cursor, CursorKind
+from concurrent.futures import ProcessPoolExecutor
+from client import get_default_socket, check_owner, send_message, receive_message
+import os
+import io
+import socket
+import pickle
+import time
+import traceback
+import contextlib
+import socketserver
 
 
 # TODO: remove logic with typedefs replacement
@@ -7,12 +17,17 @@ from clang.cindex import Cursor, CursorKind
 # TODO: add logic of handling only once to nested structures handling
 
 
+def is_from_generated_file(cursor, parser):
+    file = cursor.location.file
+    if file:  # can't get file from some cursors which points to system entities
+        return parser.is_generated_file(file.name)
+    return False
+
+
 def is_appropriate(cursor, parser, kinds):
 
     # location
-    is_from_given_file = False
-    if cursor.location.file:  # can't get file from some cursors which points to system entities
-        is_from_given_file = cursor.location.file.name == parser.currentUnit.spelling
+    is_from_given_file = is_from_generated_file(cursor, parser)
 
     # kind
     is_appropriate_kind = cursor.kind in kinds
@@ -25,34 +40,398 @@ def is_appropriate(cursor, parser, kinds):
     return is_from_given_file and is_appropriate_kind and is_registered
 
 
-def visitor_function(parent, parser, writer, kinds):
-    for cursor in parent.get_children():
+def visitor_function(parent, parser, writer, kinds, instances):
+    # top level declaration from file which is not generated: skip the whole subtree
+    skip = lambda cursor, depth: depth == 0 and not is_from_generated_file(cursor, parser)
+
+    for cursor, depth, _ in walk(parent, kinds, skip=skip):
         if is_appropriate(cursor, parser, kinds):
             type_instance = Kinds().get_instance(cursor, parser, writer)    # keep instance context
             type_instance.handle()
             if type_instance.name is not None:  # some instances should be skipped
                 writer.update_containers(type_instance)
-        visitor_function(cursor, parser, writer, kinds)
+                instances.append(type_instance)
+            type_instance.release()     # only compact record is kept, unit might be disposed
+        else:
+            profiler.count("cursors rejected")
 
 
 def traverse_ast(parser, writer, kinds):
-    for translation_unit in parser.parse_next_file():
-        visitor_function(translation_unit.cursor, parser, writer, kinds)
+    instances = list()      # in order of handling, to be resolved in the same order
+    for translation_unit in parser.parse_next_file(kinds):
+        visitor_function(translation_unit.cursor, parser, writer, kinds, instances)
+    return instances
+
+
+def stream_ast(parser, writer, kinds):
+    # every unit is resolved and generated as soon as it is walked, instances aren't kept
+    # typedefs must be known already: their declarations are generated when their files are resolved
+    resolved_files = set()
+    for translation_unit in parser.parse_next_file(kinds):
+        instances = list()
+        visitor_function(translation_unit.cursor, parser, writer, kinds, instances)
+        resolve_types(instances)
+        resolved_files.add(translation_unit.spelling)
+        resolved_files.update(instance.location for instance in instances)
+        writer.flush_stream(resolved_files)
+
+
+class Collector:
+    # stands for writer in worker process: keeps instances (with cursor keys) in order they were handled
+    def __init__(self, parser):
+        self.parser = parser
+        self.handled = list()
+
+    def update_containers(self, type_instance):
+        self.handled.append((self.parser.get_cursor_key(type_instance.cursor), type_instance))
+
+
+def extract_file(cli_args, file):
+    # handle all kinds of one file at once (might be called in worker process), types are resolved later
+    return extract_unit(Parser(cli_args), file)
+
+
+def extract_file_measured(cli_args, file):
+    # worker process of profiled run: measurements are sent back with results to be merged by parent process
+    profiler.reset()
+    profiler.enable()
+    return extract_file(cli_args, file), profiler.get_measurements()
+
+
+def extract_unit(parser, file):
+    parser.clear_registry()
+    collector = Collector(parser)
+    kinds = [kind for key in Kinds.cursorKinds.keys() for kind in key]
+    instances = list()
+    with profiler.span(file, "unit"), Kinds.scratch_tables():
+        translation_unit = parser.parse_file(file)
+        visitor_function(translation_unit.cursor, parser, collector, kinds, instances)
+    dependencies = sorted(set(inclusion.include.name for inclusion in translation_unit.get_includes()))
+    parser.dispose_unit(file)
+    return (collector.handled, instances, parser.kept_files), dependencies
+
+
+def create_executor(jobs):
+    # worker processes load libclang and create index once, for all files they handle
+    return ProcessPoolExecutor(max_workers=jobs, initializer=Parser.share_index)
+
+
+def extract_files(parser, files, executor=None):
+    settings = [parser.worker_args] * len(files)
+    if parser.jobs > 1 and executor is None:
+        with create_executor(parser.jobs) as executor:
+            return extract_files(parser, files, executor)
+    if executor is not None:
+        if not profiler.enabled:
+            return list(executor.map(extract_file, settings, files))
+        results = list()
+        for extracted, measurements in executor.map(extract_file_measured, settings, files):
+            profiler.merge(measurements)
+            results.append(extracted)
+        return results
+    return list(map(extract_file, settings, files))
+
+
+def traverse_units(parser, writer, cache=None, executor=None):
+    # files are handled independently: in worker processes (of given pool) and/or loaded from cache
+    extracted = dict()
+    if cache is not None:
+        for file in parser.files:
+            extracted[file] = cache.load(file)
+            if extracted[file] is not None:
+                parser.add_sources(file, cache.get_dependencies(file))
+    missing = [file for file in parser.files if extracted.get(file) is None]
+    for file, (file_extracted, dependencies) in zip(missing, extract_files(parser, missing, executor)):
+        extracted[file] = file_extracted
+        parser.add_sources(file, dependencies)
+        if cache is not None:
+            cache.store(file, dependencies, file_extracted)
+    if cache is not None:
+        cache.evict()
+    return merge_units(parser, writer, extracted)
+
+
+def merge_units(parser, writer, extracted):
+    # results are merged in order of files, the same as sequential traversal gives
+    instances = list()
+    for file in parser.files:
+        handled, file_instances, kept_files = extracted[file]
+        accepted = set()
+        for key, type_instance in handled:
+            if parser.register_key(key):  # the same header might be handled for several files
+                type_instance.register()
+                writer.update_containers(type_instance)
+                accepted.add(id(type_instance))
+        instances.extend(instance for instance in file_instances if id(instance) in accepted)
+        parser.add_kept_files(kept_files)
+    return instances
+
+
+def resolve_types(instances):
+    for instance in instances:
+        instance.resolve()
+
+
+def watch(parser):
+    # index, parsed units and handled instances are kept in memory, only changed units are handled again
+    units_parser = Parser(parser.worker_args)
+    units_parser.keep_units()
+    snapshots = dict()      # file -> (pickled handled instances, included files), resolved copy is used every time
+    watched = Parser.get_modification_times(parser.files)   # for parsed files and all they include
+    changed = list(parser.files)
+
+    while True:
+        if len(changed):
+            for file in changed:
+                extracted, dependencies = extract_unit(units_parser, file)
+                snapshots[file] = (pickle.dumps(extracted), dependencies)
+            for dependencies in [snapshots[file][1] for file in changed]:
+                watched.update({file: mtime for file, mtime in Parser.get_modification_times(dependencies).items()
+                                if file not in watched})
+            generate_from_snapshots(parser.worker_args, snapshots)
+            print(":: Watching for changes")
+
+        time.sleep(parser.watchInterval)
+        current = Parser.get_modification_times(watched.keys() | set(parser.files))
+        modified = {file for file, mtime in current.items() if mtime != watched.get(file)}
+        watched = current
+        changed = [file for file in parser.files if file in modified or modified.intersection(snapshots[file][1])]
+
+
+def generate_from_snapshots(cli_args, snapshots):
+    Kinds.reset()
+    parser = Parser(cli_args)   # new registry
+    writer = Writer(parser.incremental, lazy_binding=parser.lazyBinding)
+    extracted = {file: pickle.loads(snapshot) for file, (snapshot, _) in snapshots.items()}
+    for file, (_, dependencies) in snapshots.items():
+        parser.add_sources(file, dependencies)
+    print(":: Resolving types")
+    resolve_types(merge_units(parser, writer, extracted))
+    print(":: Generating wrapper")
+    generate_wrapper(parser, writer)
+
+
+def batch(parser):
+    # projects are generated one by one in one process: libclang is loaded and index is created once
+    # files listed by several projects with the same parsing context are handled once, by one pool of workers
+    Parser.share_index()
+    extracted = dict()
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(create_executor(parser.jobs)) if parser.jobs > 1 else None
+        for settings_path in parser.batch:
+            print(":: Project {}".format(settings_path))
+            with profiler.span(settings_path, "project"):
+                Kinds.reset()   # class-level tables are per project
+                project = Parser(parser.get_project_args(settings_path))
+                writer = Writer(project.incremental, lazy_binding=project.lazyBinding)
+                if project.cacheDir is not None:
+                    cache = ExtractionCache(project.cacheDir, project.cacheSize, project.cache_key_args)
+                else:
+                    cache = MemoryCache(extracted, project.cache_key_args)
+                resolve_types(traverse_units(project, writer, cache, executor))
+                generate_wrapper(project, writer)
+
+
+def serve(parser):
+    # generation server (see client.py): requests are handled one by one in this process
+    # index, handled files and resolved projects are kept in memory between requests
+    socket_path = parser.serveSocket or get_default_socket()
+    if os.path.lexists(socket_path):
+        check_owner(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            if connection.connect_ex(socket_path) == 0:
+                print(":: Server is already running on {}".format(socket_path))
+                return
+        os.remove(socket_path)  # left by server which was killed
+
+    Parser.share_index()
+    umask = os.umask(0o177)     # only current user may send requests
+    try:
+        server = socketserver.UnixStreamServer(socket_path, GenerationHandler)
+    finally:
+        os.umask(umask)
+    server.extracted = dict()   # handled files, see MemoryCache
+    server.projects = dict()    # resolved projects, see generate_project
+    server.stopped = False
+    print(":: Serving on {}".format(socket_path))
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+class GenerationHandler(socketserver.StreamRequestHandler):
+    # request = generator arguments and directory they are relative to, response = log and exit status
+    def handle(self):
+        message = receive_message(self.rfile)
+        if message is None:
+            return
+        if message.get("stop"):
+            self.server.stopped = True
+            send_message(self.wfile, {"log": ":: Server stopped\n", "status": 0})
+            return
+
+        print(":: Request: {} {}".format(message["cwd"], " ".join(message["args"])))
+        log = io.StringIO()
+        directory = os.getcwd()
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                os.chdir(message["cwd"])
+                status = generate_request(message["args"], self.server.extracted, self.server.projects)
+            except SystemExit as error:     # wrong arguments or help
+                status = error.code if isinstance(error.code, int) else int(error.code is not None)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os.chdir(directory)
+        send_message(self.wfile, {"log": log.getvalue(), "status": status})
+
+
+def generate_request(cli_args, extracted, projects):
+    # files are always handled independently, so output is the same for any of generator modes
+    parser = Parser(cli_args)
+    if parser.watchInterval is not None or parser.serveSocket is not None:
+        print(":: Watch and serve modes can't be requested from server")
+        return 2
+    profiler.reset()
+    if parser.profilePath is not None:
+        profiler.enable()
+
+    if parser.batch is not None:
+        with contextlib.ExitStack() as stack:
+            executor = stack.enter_context(create_executor(parser.jobs)) if parser.jobs > 1 else None
+            for settings_path in parser.batch:
+                print(":: Project {}".format(settings_path))
+                with profiler.span(settings_path, "project"):
+                    generate_project(Parser(parser.get_project_args(settings_path)), extracted, projects, executor)
+    else:
+        generate_project(parser, extracted, projects)
+
+    save_profile(parser)
+    return 0
+
+
+def generate_project(parser, extracted, projects, executor=None):
+    # handled file is reused while its contents and contents of files it includes are the same
+    # resolved project is reused as a whole while none of its files and its settings are changed
+    Kinds.reset()
+    writer = Writer(parser.incremental, lazy_binding=parser.lazyBinding)
+    cache = MemoryCache(extracted, parser.cache_key_args, validate=True, max_size=parser.cacheSize)
+    key = repr((os.getcwd(), parser.worker_args))
+    resolved = projects.pop(key, None)
+
+    if resolved is not None and not cache.is_changed(resolved[0]):
+        print(":: Reusing resolved types")
+        containers, CommonTypeData.symbols, CommonTypeData.ctypes, kept_files = pickle.loads(resolved[1])
+        for type_instance in containers:    # nested declarations as well
+            writer.update_containers(type_instance)
+        parser.add_kept_files(kept_files)
+        projects[key] = resolved    # keep recently used
+    else:
+        print(":: Processing typedefs, macros, user types and functions. Processes: {} ".format(parser.jobs))
+        with profiler.span("extraction"):
+            instances = traverse_units(parser, writer, cache, executor)
+        print(":: Resolving types")
+        with profiler.span("resolve"):
+            resolve_types(instances)
+        if not parser.incremental:  # incremental writer depends on previous output, not on files only
+            files = {parser.settingsPath}.union(*(cache.get_dependencies(file) for file in parser.files))
+            containers = [instance for container in writer.containers.values() for instance in container]
+            projects[key] = (cache.get_hashes(files), pickle.dumps(
+                (containers, CommonTypeData.symbols, CommonTypeData.ctypes, parser.kept_files)))
+            MemoryCache.evict_entries(projects, parser.cacheSize)
+
+    print(":: Generating wrapper")
+    with profiler.span("output"):
+        generate_wrapper(parser, writer)
+
+
+def generate_wrapper(parser, writer):
+    if parser.incremental:
+        writer.set_sources(parser.sources, parser.sources_context)
+    if parser.package:
+        writer.generate_package(parser.output_package, parser.generated_files, parser.project)
+    else:
+        writer.generate_output(parser.outputFile, parser.generated_files, parser.project)
 
 
 def main():
     parser = Parser()
-    writer = Writer()
+    if parser.serveSocket is not None:
+        try:
+            serve(parser)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if parser.profilePath is not None:
+        profiler.enable()
+
+    if parser.batch is not None:
+        batch(parser)
+        save_profile(parser)
+        return
+
+    writer = Writer(parser.incremental, parser.stream, parser.lazyBinding)
 
-    print(":: Preparing. Processing typedefs ")
-    traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
+    if parser.watchInterval is not None:
+        try:
+            watch(parser)
+        except KeyboardInterrupt:
+            pass
+        return
 
-    print(":: Processing macros, user types and functions ")
-    kinds = [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key]
-    traverse_ast(parser, writer, kinds)
+    if parser.jobs > 1 or parser.cacheDir is not None:
+        print(":: Processing typedefs, macros, user types and functions. Processes: {} ".format(parser.jobs))
+        cache = None
+        if parser.cacheDir is not None:
+            cache = ExtractionCache(parser.cacheDir, parser.cacheSize, parser.cache_key_args)
+        with profiler.span("extraction"):
+            instances = traverse_units(parser, writer, cache)
+
+    elif parser.singlePass:
+        # every file is parsed once, types are resolved when all typedefs are known
+        print(":: Processing typedefs, macros, user types and functions ")
+        kinds = [kind for key in Kinds.cursorKinds.keys() for kind in key]
+        with profiler.span("traversal"):
+            instances = traverse_ast(parser, writer, kinds)
+
+    else:
+        print(":: Preparing. Processing typedefs ")
+        with profiler.span("typedefs"):
+            traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
+
+        kinds = [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key]
+        if parser.stream:
+            print(":: Processing macros, user types and functions, resolving and generating them file by file ")
+            with profiler.span("traversal"):
+                stream_ast(parser, writer, kinds)
+            instances = list()
+        else:
+            print(":: Processing macros, user types and functions ")
+            with profiler.span("traversal"):
+                instances = traverse_ast(parser, writer, kinds)
+
+    print(":: Resolving types")
+    with profiler.span("resolve"):
+        resolve_types(instances)
+    print("   types cache: {}".format(CommonTypeData.ctypes))
 
     print(":: Generating wrapper")
-    writer.generate_output(parser.outputFile, parser.files, parser.project)
+    with profiler.span("output"):
+        generate_wrapper(parser, writer)
+
+    save_profile(parser)
+
+
+def save_profile(parser):
+    if parser.profilePath is not None:
+        profiler.save(parser.profilePath, parser.tracePath,
+                      ctypesHits=CommonTypeData.ctypes.hits, ctypesMisses=CommonTypeData.ctypes.misses)
+        print(":: Profile saved to {}".format(parser.profilePath))
 
 
 if __name__ == "__main__":
@@ -1,3 +1,7 @@
 from .kinds import Kinds, CommonTypeData, Typedef, Enum, StructUnion
 from .parser import Parser
 from .writer import Writer
+from .walker import walk
+from .cache import ExtractionCache, MemoryCache
+from .symbols import SymbolTable
+from .profiler import Profiler, profiler
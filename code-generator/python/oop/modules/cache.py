@@ -0,0 +1,191 @@
+import os
+import pickle
+import hashlib
+from clang.cindex import TranslationUnit, TranslationUnitLoadError, TranslationUnitSaveError
+
+
+class DirectoryCache:
+
+    _suffix = None                      # extension of entry files
+
+    def __init__(self, directory, max_size, key_args):
+        self._directory = directory
+        self._maxSize = max_size        # bytes, least recently used entries are evicted
+        self._keyArgs = key_args        # everything besides files contents which affects entry
+        os.makedirs(self._directory, exist_ok=True)
+
+    def get_entry_key(self, file):
+        return repr((os.path.abspath(file), self._keyArgs))
+
+    def get_entry_path(self, file):
+        key = hashlib.sha256(self.get_entry_key(file).encode()).hexdigest()
+        return os.path.join(self._directory, key + self._suffix)
+
+    def evict(self):
+        entries = list()
+        for name in os.listdir(self._directory):
+            if name.endswith(self._suffix):
+                stat = os.stat(os.path.join(self._directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self._maxSize:
+                break
+            self.remove_entry(os.path.join(self._directory, name))
+            total_size -= size
+
+    def remove_entry(self, entry_path):
+        os.remove(entry_path)
+
+
+class ContentHashes:
+
+    # contents hashes of files, every file is read once per cache instance (i.e. per run or per served request)
+
+    _hashes = None                      # file name -> contents hash
+
+    def get_file_hash(self, file):
+        if self._hashes is None:
+            self._hashes = dict()
+        if file not in self._hashes:
+            try:
+                with open(file, mode="rb") as source:
+                    self._hashes[file] = hashlib.sha256(source.read()).hexdigest()
+            except OSError:
+                self._hashes[file] = None
+        return self._hashes[file]
+
+    def get_hashes(self, files):
+        return {file: self.get_file_hash(file) for file in files}
+
+    def is_changed(self, hashes):
+        return any(self.get_file_hash(file) != file_hash for file, file_hash in hashes.items())
+
+
+class ExtractionCache(DirectoryCache, ContentHashes):
+
+    # cache entry = instances handled for one parsed file (see generator.extract_file)
+    # entry is valid while contents of parsed file, contents of all included files and parser args are the same
+
+    _suffix = ".pickle"
+    _version = 2                        # increase when handled instances format is changed
+
+    def __init__(self, directory, max_size, key_args):
+        super().__init__(directory, max_size, key_args)
+        self._dependencies = dict()     # file -> files it includes, for loaded entries
+
+    def get_entry_key(self, file):
+        return repr((self._version, os.path.abspath(file), self.get_file_hash(file), self._keyArgs))
+
+    def load(self, file):
+        entry_path = self.get_entry_path(file)
+        try:
+            with open(entry_path, mode="rb") as entry:
+                dependencies, extracted = pickle.load(entry)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if self.is_changed(dependencies):     # any of included files was changed
+            return None
+
+        os.utime(entry_path)    # keep recently used
+        self._dependencies[file] = dependencies.keys()
+        return extracted
+
+    def get_dependencies(self, file):
+        return self._dependencies.get(file, ())
+
+    def store(self, file, dependencies, extracted):
+        dependencies = self.get_hashes(dependencies)
+        entry_path = self.get_entry_path(file)
+        temp_path = entry_path + ".tmp"
+        with open(temp_path, mode="wb") as entry:
+            pickle.dump((dependencies, extracted), entry, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, entry_path)
+
+
+class MemoryCache(ContentHashes):
+
+    # the same interface as ExtractionCache, entries are kept in memory for one run (files aren't changed meanwhile)
+    # entries dictionary might be shared by several projects: the same file parsed with the same args is handled once
+    # validated entries outlive the run (see generator.serve): they are valid while the file and its includes are the same
+
+    def __init__(self, entries, key_args, validate=False, max_size=None):
+        self._entries = entries         # entry key -> (files with hashes if validated, pickled instances), oldest first
+        self._keyArgs = key_args
+        self._validate = validate
+        self._maxSize = max_size        # bytes of pickled instances, least recently used entries are evicted
+        self._dependencies = dict()     # file -> files it includes, for loaded and stored entries
+
+    def get_entry_key(self, file):
+        return repr((os.path.abspath(file), self._keyArgs))
+
+    def load(self, file):
+        key = self.get_entry_key(file)
+        entry = self._entries.pop(key, None)
+        if entry is None or (self._validate and self.is_changed(entry[0])):
+            return None
+        self._entries[key] = entry      # keep recently used
+        self._dependencies[file] = entry[0].keys()
+        return pickle.loads(entry[1])   # every project resolves its own copy
+
+    def store(self, file, dependencies, extracted):
+        files = [file] + dependencies
+        hashes = self.get_hashes(files) if self._validate else dict.fromkeys(files)
+        self._entries[self.get_entry_key(file)] = (hashes, pickle.dumps(extracted, protocol=pickle.HIGHEST_PROTOCOL))
+        self._dependencies[file] = hashes.keys()
+
+    def get_dependencies(self, file):
+        # the file itself and all files it includes
+        return self._dependencies.get(file, ())
+
+    def evict(self):
+        if self._maxSize is not None:
+            self.evict_entries(self._entries, self._maxSize)
+
+    @staticmethod
+    def evict_entries(entries, max_size):
+        # entries = key -> (..., pickled bytes), oldest first
+        total_size = sum(len(entry[1]) for entry in entries.values())
+        for key in list(entries):
+            if total_size <= max_size:
+                break
+            total_size -= len(entries.pop(key)[1])
+
+
+class AstCache(DirectoryCache):
+
+    # cache entry = saved translation unit of parsed file and its key
+    # clang itself rejects saved unit if any of files it was parsed from was changed
+
+    _suffix = ".ast"
+
+    def load(self, file, index):
+        entry_path = self.get_entry_path(file)
+        try:
+            with open(entry_path + ".key", mode="r") as key_file:
+                if key_file.read() != self.get_entry_key(file):
+                    return None
+            unit = TranslationUnit.from_ast_file(entry_path, index)
+        except (OSError, TranslationUnitLoadError):
+            return None
+
+        os.utime(entry_path)    # keep recently used
+        return unit
+
+    def store(self, file, unit):
+        entry_path = self.get_entry_path(file)
+        temp_path = entry_path + ".tmp"
+        try:
+            unit.save(temp_path)
+        except TranslationUnitSaveError:
+            return
+        os.replace(temp_path, entry_path)
+        with open(entry_path + ".key", mode="w") as key_file:
+            key_file.write(self.get_entry_key(file))
+
+    def remove_entry(self, entry_path):
+        os.remove(entry_path)
+        if os.path.exists(entry_path + ".key"):
+            os.remove(entry_path + ".key")
@@ -1,4 +1,7 @@
-from clang.cindex import Cursor, CursorKind, TokenGroup
+from clang.cindex import Cursor, CursorKind
+from collections import OrderedDict
+import contextlib
+from .symbols import SymbolTable
 
 
 typesMapping = {
@@ -68,30 +71,158 @@ class Kinds:
             return self.types[cursor.kind](cursor, parser, writer)
         return None
 
+    @classmethod
+    def reset(cls):
+        # class-level tables must be cleared before the same declarations are handled again
+        CommonTypeData.symbols = SymbolTable()
+        CommonTypeData.ctypes.clear()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def scratch_tables():
+        # handling in this process the same way as in worker one: names registered while handling are dropped,
+        # handled instances register them once, when they are merged (see generator.merge_units)
+        symbols, ctypes = CommonTypeData.symbols, CommonTypeData.ctypes
+        CommonTypeData.symbols, CommonTypeData.ctypes = SymbolTable(), CtypeCache(ctypes.maxSize)
+        try:
+            yield
+        finally:
+            CommonTypeData.symbols, CommonTypeData.ctypes = symbols, ctypes
+
+    @staticmethod
+    def get_tables():
+        # class-level tables types are resolved with
+        return CommonTypeData.symbols
+
+
+class CtypeCache:
+
+    # get_ctype() results for type spellings, bounded (least recently used are dropped)
+    # entry is dropped when any name it was resolved through is registered as typedef, enum or structure
+
+    def __init__(self, max_size=4096):
+        self.maxSize = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # spelling -> (ctype, names it was resolved through)
+        self._dependents = dict()       # name -> spellings resolved through it
+        self._warned = set()            # unrecognized types reported already, entries of them might be dropped
+
+    def get(self, spelling):
+        entry = self._entries.get(spelling)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(spelling)
+        return entry[0]
+
+    def put(self, spelling, ctype, names):
+        self._entries[spelling] = (ctype, names)
+        for name in names:
+            self._dependents.setdefault(name, set()).add(spelling)
+        if len(self._entries) > self.maxSize:
+            self.drop(next(iter(self._entries)))
+
+    def invalidate(self, *names):
+        for name in names:
+            for spelling in list(self._dependents.get(name, ())):
+                self.drop(spelling)
+
+    def drop(self, spelling):
+        _, names = self._entries.pop(spelling)
+        for name in names:
+            self._dependents[name].discard(spelling)
+            if not len(self._dependents[name]):
+                del self._dependents[name]
+
+    def clear(self):
+        self._entries.clear()
+        self._dependents.clear()
+        self._warned.clear()
+
+    def is_warned(self, name):
+        # the first call for name returns False: every unrecognized type is reported once
+        if name in self._warned:
+            return True
+        self._warned.add(name)
+        return False
+
+    def __str__(self):
+        return "{} hits, {} misses, {} entries".format(self.hits, self.misses, len(self._entries))
+
 
 class CommonTypeData:
+    # instance is a compact record: clang context is necessary only while handling (see release)
+    __slots__ = ("cursor", "parser", "writer", "name", "kind", "location")
+    _context = ("cursor", "parser", "writer")
+
+    dependsOnTables = True      # output depends on class-level tables (types are resolved with them)
+    symbols = SymbolTable()     # common for all kinds
+    ctypes = CtypeCache()       # common for all kinds
+
     def __init__(self, cursor, parser, writer):
         # keep full context for particular type
         self.cursor = cursor        # first time type was met
         self.parser = parser        # particular unit, necessary to handle location and tokens
         self.writer = writer        # output file which this type should be generated in
         self.name = None
-
-    @property
-    def location(self):
-        return self.cursor.location.file.name
+        self.kind = cursor.kind
+        self.location = cursor.location.file.name if cursor.location.file else None
 
     def handle(self):
         raise NotImplementedError
 
+    def resolve(self):
+        # part of handling which depends on types declared anywhere (typedefs, user's types)
+        # called after all files are traversed, in the same order instances were handled
+        pass
+
+    def register(self):
+        # keep declared names in class-level tables
+        # called by handle(), or on merge if instance was handled in another process
+        pass
+
+    def release(self):
+        # drop clang context once handled, so translation unit isn't kept alive by record
+        for attribute in self._context:
+            setattr(self, attribute, None)
+
+    @classmethod
+    def get_slots(cls):
+        return [slot for klass in reversed(cls.__mro__) for slot in getattr(klass, "__slots__", ())]
+
+    def __getstate__(self):
+        # handled instance is sent between processes or cached without clang context
+        state = {slot: getattr(self, slot) for slot in self.get_slots() if slot not in self._context}
+        state["kind"] = self.kind.value
+        return state
+
+    def __setstate__(self, state):
+        for attribute in self._context:
+            setattr(self, attribute, None)
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.kind = CursorKind.from_id(self.kind)
+
     def generate(self, wrapper):
         raise NotImplementedError
 
     @staticmethod
     def get_ctype(input_type):
+        ctype = CommonTypeData.ctypes.get(input_type)
+        if ctype is None:
+            ctype, names = CommonTypeData.resolve_ctype(input_type)
+            CommonTypeData.ctypes.put(input_type, ctype, names)
+        return ctype
+
+    @staticmethod
+    def resolve_ctype(input_type):
         base_type, pointers_count, array_sizes = CommonTypeData.get_base_type(input_type)
+        names = Typedef.get_alias_chain(base_type)  # result depends on these names only
         base_type = Typedef.get_type(base_type)
         base_canonical_underlying = Typedef.get_canonical_underlying(base_type)
+        names.update(Typedef.get_alias_chain(base_type))
 
         # explicit types mapping
         if base_type in typesMapping.keys():
@@ -133,9 +264,10 @@ class CommonTypeData:
         # type is from parsed but not generated file
         else:
             ctype = 'c_void_p'
-            print("Warning! Type '{}' was not recognized and was replaced with 'c_void_p'. "
-                  "If it was expected or replace was incorrect, put explicit mapping rule to the kinds.py module"
-                  .format(base_type))
+            if not CommonTypeData.ctypes.is_warned(base_type):
+                print("Warning! Type '{}' was not recognized and was replaced with 'c_void_p'. "
+                      "If it was expected or replace was incorrect, put explicit mapping rule to the kinds.py module"
+                      .format(base_type))
 
         # apply pointers
         for i in range(pointers_count):
@@ -145,7 +277,7 @@ class CommonTypeData:
         for size in array_sizes:
             ctype = ctype + " * {}".format(size)
 
-        return ctype
+        return ctype, names
 
     @staticmethod
     def get_base_type(input_type):
@@ -186,8 +318,7 @@ class CommonTypeData:
 
 
 class Typedef(CommonTypeData):
-    _aliases = dict()
-    _underlyings = dict()
+    __slots__ = ("underlying", )
 
     def __init__(self, cursor, parser, writer):
         super().__init__(cursor, parser, writer)
@@ -197,6 +328,9 @@ class Typedef(CommonTypeData):
     def handle(self):
         self.name = self.cursor.type.spelling
         self.underlying = self.cursor.underlying_typedef_type.spelling
+        self.register()
+
+    def register(self):
         self._update_typedefs(self.name, self.underlying)
 
     def generate(self, wrapper):
@@ -236,11 +370,31 @@ class Typedef(CommonTypeData):
 
     @classmethod
     def _update_typedefs(cls, alias, underlying):
-        cls._aliases[alias] = underlying
-        if underlying in cls._underlyings.keys():
-            cls._underlyings[underlying].append(alias)
+        CommonTypeData.ctypes.invalidate(alias, underlying)
+        cls.symbols.add_typedef(alias, underlying)
+        cls._update_canonicals(alias, underlying)
+
+    @classmethod
+    def _update_canonicals(cls, alias, underlying):
+        # aliases declared through given one (directly or not) have the same canonical underlying
+        affected = {alias}
+        pending = [alias]
+        while len(pending):
+            current = pending.pop()
+            for dependent in cls.symbols.underlyings.get(current, []):
+                if cls.symbols.aliases[dependent] == current and dependent not in affected:   # not redeclared
+                    affected.add(dependent)
+                    pending.append(dependent)
+
+        if underlying in affected:
+            print("Warning! Typedef '{}' for '{}' is cyclic, it is considered as canonical type"
+                  .format(alias, underlying))
+            canonical = alias
         else:
-            cls._underlyings[underlying] = [alias]
+            canonical = cls.symbols.canonicals.get(underlying, underlying)
+
+        for current in affected:
+            cls.symbols.canonicals[current] = canonical
 
     @classmethod
     def get_type(cls, input_type):
@@ -264,25 +418,32 @@ class Typedef(CommonTypeData):
                 return underlying_type
 
             # alias for user type or user type which alias is available for was given
-            if underlying_type in cls._underlyings.keys():
-                return cls._underlyings[underlying_type][0]
+            if underlying_type in cls.symbols.underlyings:
+                return cls.symbols.underlyings[underlying_type][0]
 
             # possible only if input_type is user's and if it was never used in typedef statements
             return input_type
 
     @classmethod
     def get_canonical_underlying(cls, alias):
-        if alias in cls._aliases.keys():
-            return cls.get_canonical_underlying(cls._aliases[alias])
-        else:
-            return alias
+        return cls.symbols.canonicals.get(alias, alias)
+
+    @classmethod
+    def get_alias_chain(cls, alias):
+        chain = {alias}
+        while alias in cls.symbols.aliases and cls.symbols.aliases[alias] not in chain:
+            alias = cls.symbols.aliases[alias]
+            chain.add(alias)
+        return chain
 
     @classmethod
     def is_known(cls, alias):
-        return alias in cls._aliases.keys()
+        return alias in cls.symbols.aliases
 
 
 class Macro(CommonTypeData):
+    __slots__ = ("value", )
+    dependsOnTables = False
 
     def __init__(self, cursor, parser, writer):
         super().__init__(cursor, parser, writer)
@@ -290,9 +451,7 @@ class Macro(CommonTypeData):
 
     def handle(self):
 
-        tokens = []
-        for token in TokenGroup.get_tokens(self.parser.currentUnit, self.cursor.extent):
-            tokens.append(token.spelling)
+        tokens = self.parser.get_tokens(self.cursor.extent)
 
         # MACRO 1 or MACRO "string"
         if len(tokens) == 2:
@@ -316,25 +475,27 @@ class Macro(CommonTypeData):
 
 
 class Enum(CommonTypeData):
-    _enums = list()
+    __slots__ = ("constants", )
 
     def __init__(self, cursor, parser, writer):
         super().__init__(cursor, parser, writer)
         self.constants = dict()
 
     def handle(self):
+        self.name = self.cursor.type.spelling
+        for const in self.cursor.get_children():
+            self.constants[const.displayname] = const.enum_value
+
+    def resolve(self):
         # keep all handled enums original names
         # necessary for correct get_ctype() working
-        self.name = self.cursor.type.spelling
-        self.__class__._enums.append(self.name)
+        self.symbols.add_enum(self.name)
+        CommonTypeData.ctypes.invalidate(self.name)
 
         alias = Typedef.get_type(self.name)
         if alias is not None:
             self.name = alias
 
-        for const in self.cursor.get_children():
-            self.constants[const.displayname] = const.enum_value
-
     def generate(self, wrapper):
         wrapper.write("\n# {}\n".format(self.name))
         for name, value in self.constants.items():
@@ -342,18 +503,48 @@ class Enum(CommonTypeData):
 
     @classmethod
     def is_known(cls, input_type):
-        return input_type in cls._enums
+        return input_type in cls.symbols.enums
 
 
 class StructUnion(CommonTypeData):
-    _structs_unions = list()
-    _incomplete = list()
+    __slots__ = ("fields", "members", "spelling", "anonymous")
 
     def __init__(self, cursor, parser, writer):
         super().__init__(cursor, parser, writer)
         self.fields = dict()
+        self.members = list()       # children info, turned into fields by resolve()
+        self.spelling = None
+        self.anonymous = False      # nested anonymous declaration gets its name from outer structure
 
     def handle(self):
+        self.spelling = self.cursor.type.spelling
+        self.name = self.spelling   # replaced with common name by resolve()
+
+        for field in self.cursor.get_children():
+
+            # nested declaration: (declaration, is anonymous, is handled as part of this structure)
+            field_declaration = self.is_nested_declaration(field)
+            if field_declaration is not None:
+                is_registered = self.parser.register_cursor(field)
+                if is_registered:
+                    field_declaration.handle()
+                    if field_declaration.name is not None:  # some instances should be skipped
+                        self.writer.update_containers(field_declaration)
+                self.members.append((field_declaration, field.is_anonymous(), is_registered))
+
+            # members: (None, is anonymous, name, type spelling, bit width, is callback)
+            else:
+                field_width = field.get_bitfield_width() if field.is_bitfield() else 0
+                self.members.append((None, field.is_anonymous(), field.displayname, field.type.spelling,
+                                     field_width, self.is_callback(field)))
+
+    def release(self):
+        super().release()
+        for member in self.members:
+            if member[0] is not None:
+                member[0].release()
+
+    def resolve(self):
 
         # variables to deal with nested anonymous structures and unions
         anon_fields_counter = 0     # auto naming counter
@@ -361,76 +552,69 @@ class StructUnion(CommonTypeData):
         is_anon_scope = False       # cover the case with 'struct' as an anonymous scope
 
         # know if current structure is anonymous
-        if hasattr(self.cursor, "anon_type_name"):
-            self.name = self.cursor.anon_type_name
-            self.__class__._structs_unions.append(self.name)
+        if self.anonymous:
+            self.symbols.add_struct_union(self.name)
+            CommonTypeData.ctypes.invalidate(self.name)
         else:
             # keep all handled structures original names. [!] necessary for correct get_ctype() processing
-            self.__class__._structs_unions.append(self.cursor.type.spelling)
+            self.symbols.add_struct_union(self.spelling)
+            CommonTypeData.ctypes.invalidate(self.spelling)
             # get common name
-            self.name = Typedef.get_type(self.cursor.type.spelling)
+            self.name = Typedef.get_type(self.spelling)
             self.name = self.name.replace("struct ", "struct_")  # if type doesn't have aliases
             self.name = self.name.replace("union ", "union_")  # if type doesn't have aliases
 
-        for field in self.cursor.get_children():
-
-            # check for nested declarations
-            temp_type_name = self.name + "_anon_{}".format(anon_fields_counter)
-            field_declaration = self.is_nested_declaration(field, temp_type_name)
+        for member in self.members:
+            field_declaration, is_anonymous = member[0], member[1]
 
             # nested declaration
             if field_declaration is not None:
-                anon_type_name = temp_type_name
+                anon_type_name = self.name + "_anon_{}".format(anon_fields_counter)
 
                 # consider anonymous declaration as an anonymous scope anyway
-                if field.is_anonymous():
+                if is_anonymous:
                     if not is_anon_scope:
                         self.fields["_scope"] = (anon_type_name, 0)
                         is_anon_scope = True
 
                 anon_fields_counter += 1
-                if self.parser.register_cursor(field):
-                    field_declaration.handle()
-                    if field_declaration.name is not None:  # some instances should be skipped
-                        self.writer.update_containers(field_declaration)
+                if member[2]:
+                    if field_declaration.anonymous:
+                        field_declaration.name = anon_type_name
+                    field_declaration.resolve()
 
             # members (of both nested and usual declared types)
             else:
-                if field.is_anonymous():
+                field_name, field_spelling, field_width, is_callback = member[2:]
+                if is_anonymous:
                     if is_anon_scope:
                         # if we are here, it means anonymous declaration is a named member (not an anonymous scope)
                         self.fields.pop("_scope", None)
                     field_type = anon_type_name
                 else:
-                    field_type = self.get_ctype(field.type.spelling)
-
-                field_name = field.displayname
-                field_width = field.get_bitfield_width() if field.is_bitfield() else 0
+                    field_type = self.get_ctype(field_spelling)
 
                 # handle callbacks. Not necessary. The reason: callback is typedef kind ...
                 # ... if skip this check, all of identical callbacks would be replaced with the same typedef
-                if self.is_callback(field):
-                    field_type = field.type.spelling  # the exact input name without getting ctype
+                if is_callback:
+                    field_type = field_spelling  # the exact input name without getting ctype
 
                 # handle pointer to structure itself: if field type is pointer to structure name or to alias ...
                 if field_type.find("POINTER(" + self.name + ")") != -1:
                     field_type = field_type.replace("POINTER(" + self.name + ")", ThisPointer)
 
                 # ... or if field type is 'handler' = alias to pointer to structure or alias
-                elif self.is_handler(field.type.spelling):
-                    field_type = field_type.replace(self.get_base_type(field.type.spelling)[0], ThisPointer)
+                elif self.is_handler(field_spelling):
+                    field_type = field_type.replace(self.get_base_type(field_spelling)[0], ThisPointer)
                     field_type = field_type.replace('c_void_p', ThisPointer)
 
                 self.fields[field_name] = (field_type, field_width)
 
-        if not len(self.fields):
-            self.__class__._incomplete.append(self.name)
-        elif self.name in self.__class__._incomplete:
-            self.__class__._incomplete.remove(self.name)
+        self.symbols.set_incomplete(self.name, not len(self.fields))
 
     def generate(self, wrapper):
         incomplete = "# incomplete type, pointers to type replaced with 'c_void_p'" if not len(self.fields) else ""
-        wrapper.write("\n\nclass {}({}):  {}\n".format(self.name, "Structure" if self.cursor.kind == CursorKind.STRUCT_DECL else "Union", incomplete))
+        wrapper.write("\n\nclass {}({}):  {}\n".format(self.name, "Structure" if self.kind == CursorKind.STRUCT_DECL else "Union", incomplete))
         wrapper.write("    _fields_ = [")
 
         for field_name, field_type_info in self.fields.items():
@@ -442,16 +626,16 @@ class StructUnion(CommonTypeData):
 
     @classmethod
     def is_known(cls, input_type):
-        return input_type in cls._structs_unions
+        return input_type in cls.symbols.structs_unions
 
     @classmethod
     def is_incomplete(cls, input_type):
-        return input_type in cls._incomplete
+        return input_type in cls.symbols.incomplete
 
-    def is_nested_declaration(self, cursor, name):
-        if cursor.type.get_declaration().is_anonymous():
-            cursor.anon_type_name = name
+    def is_nested_declaration(self, cursor):
         field_declaration = Kinds().get_instance(cursor, self.parser, self.writer)
+        if isinstance(field_declaration, StructUnion) and cursor.type.get_declaration().is_anonymous():
+            field_declaration.anonymous = True
         return field_declaration
 
     def is_callback(self, cursor):
@@ -466,6 +650,7 @@ class StructUnion(CommonTypeData):
 
 
 class Function(CommonTypeData):
+    __slots__ = ("type", "args")
 
     def __init__(self, cursor, parser, writer):
         super().__init__(cursor, parser, writer)
@@ -477,9 +662,13 @@ class Function(CommonTypeData):
         if self.name.startswith('ENUM') or self.name.startswith('SDK_') or self.name.endswith('ToString'):
             self.name = None
         else:
-            self.type = self.get_ctype(self.cursor.type.get_result().spelling)
+            self.type = self.cursor.type.get_result().spelling
             for arg in self.cursor.get_arguments():
-                self.args.append(self.get_ctype(arg.type.spelling))
+                self.args.append(arg.type.spelling)
+
+    def resolve(self):
+        self.type = self.get_ctype(self.type)
+        self.args = [self.get_ctype(arg) for arg in self.args]
 
     def generate(self, wrapper):
         tab = "            "
@@ -495,3 +684,7 @@ class Function(CommonTypeData):
             wrapper.write("{}".format(self.args[len(self.args) - 1]))
         wrapper.write("]\n\n")
 
+    def generate_prototype(self, wrapper):
+        # entry of Class._prototypes for lazy binding
+        wrapper.write("        \"{}\": ({}, [{}]),\n".format(self.name, self.type, ", ".join(self.args)))
+
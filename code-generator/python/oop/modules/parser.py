@@ -1,7 +1,14 @@
 import os
 import argparse
 import json
-from clang.cindex import TranslationUnit, Index, CursorKind
+from clang.cindex import TranslationUnit, Index, CursorKind, Diagnostic, TokenGroup
+from .cache import AstCache
+from .profiler import profiler
+
+
+# libclang parse options which python bindings don't declare
+PARSE_KEEP_GOING = 0x200            # don't stop on fatal errors (e.g. missing include)
+PARSE_SINGLE_FILE = 0x400           # #include'd files are not processed at all
 
 
 class Parser:
@@ -11,44 +18,221 @@ class Parser:
     _parseFiles = None
     _clangArgs = None
     _clangOptions = None
+    _keepPaths = None               # headers from these directories are generated as well as parsed files
     outputFile = None
+    settingsPath = None
+    singlePass = False              # parse every file once, typedefs are collected in the same traversal
+    jobs = 1                        # number of processes files are parsed in
+    cacheDir = None                 # directory to keep handled instances of parsed files between runs
+    cacheSize = None
+    astCacheDir = None              # directory to keep saved translation units between runs
+    watchInterval = None            # seconds between checks of files modification in watch mode
+    incremental = False             # regenerate only changed sections of output
+    stream = False                  # generate declarations of every unit as soon as it is resolved
+    lazyBinding = False             # generated Class binds functions on first access
+    profilePath = None              # json report of phases and units timings and counters
+    tracePath = None                # chrome trace events of phases and units
+    batch = None                    # settings files of projects generated one by one in one run
+    serveSocket = None              # unix socket generation requests are accepted on (see client.py)
+    fastParse = False               # parse only file itself, fall back to full parse if its declarations aren't resolved
+    settingsRelative = False        # relative project and output are relative to settings file, not to working directory
+    package = False                 # output is package with module for every generated file
 
     # context itself
     _parserIndex = None             # common context for files would be parsed by clang
     currentUnit = None
     _cursorRegistrator = None       # prevent double handling of the same cursor (different cases are possible)
+    _generatedFiles = None          # file name -> is generated, to avoid checking paths for every cursor
+    _keptFiles = None               # generated headers from keep paths in order they were met
+    _sources = None                 # parsed file -> files it includes, sections of incremental output depend on them
+    _astCache = None
+    _units = None                   # file -> (unit, files modification times, is parsed from source), if units are kept
 
     def __init__(self, cli_args=None):
         self._settings_parser = self.initialize_argument_parser()
         self.parse_cli_args(cli_args)
         self.initialize_defaults()
-        self._parserIndex = Index.create()
-        self._cursorRegistrator = list()
+        self._cursorRegistrator = set()
+        self._generatedFiles = dict()
+        self._keptFiles = list()
+        self._sources = dict()
+        if self.astCacheDir is not None:
+            self._astCache = AstCache(self.astCacheDir, self.cacheSize, self.cache_key_args)
 
     def parse_cli_args(self, cli_args=None):
         args = self._settings_parser.parse_args(cli_args)
+        self.settingsPath = args.jsonPath
+        self.singlePass = args.singlePass
+        self.jobs = args.jobs
+        self.cacheDir = args.cacheDir
+        self.cacheSize = args.cacheSize * 1024 * 1024
+        self.astCacheDir = args.astCacheDir
+        self.watchInterval = args.watchInterval
+        self.incremental = args.incremental
+        self.stream = args.stream
+        self.lazyBinding = args.lazyBinding
+        self.package = args.package
+        self.profilePath = args.profilePath
+        self.tracePath = args.tracePath
+        self.fastParse = args.fastParse
+        self.settingsRelative = args.settingsRelative
+        if self.package and self.incremental:
+            self._settings_parser.error("--package can't be combined with incremental mode")
+        if self.stream and (self.singlePass or self.jobs > 1 or self.cacheDir is not None
+                            or self.watchInterval is not None or self.incremental):
+            self._settings_parser.error("--stream can't be combined with single pass, jobs, cache, watch "
+                                        "or incremental modes")
+        if args.serveSocket is not None:
+            if self.stream or self.watchInterval is not None or args.batch is not None:
+                self._settings_parser.error("--serve can't be combined with stream, watch or batch modes")
+            self.serveSocket = args.serveSocket
+            return  # every request has its own settings
+        if args.batch is not None:
+            if self.stream or self.watchInterval is not None:
+                self._settings_parser.error("--batch can't be combined with stream or watch modes")
+            self.batch = self.get_batch_settings(args.batch)
+            return  # every project is parsed with its own settings
+
         settings_file = open(args.jsonPath, mode="r")
         settings_dict = json.load(settings_file)
 
         self._projectPath = settings_dict["project"]
-        self._parseFiles = [os.path.join(self._projectPath, file) for file in settings_dict["files"]]
         self.outputFile = settings_dict["output"]
+        if self.settingsRelative:
+            self._projectPath = os.path.join(os.path.dirname(args.jsonPath), self._projectPath)
+            self.outputFile = os.path.join(os.path.dirname(args.jsonPath), self.outputFile)
+        normalize = lambda path: path
+        if self.astCacheDir is not None or self.settingsRelative:
+            # units loaded from ast file have absolute files names, parsed ones should have the same
+            # batch projects name shared headers the same way, so they are handled once (see cache_key_args)
+            self._projectPath = os.path.join(os.path.abspath(self._projectPath), "")
+            normalize = os.path.normpath
+        self._parseFiles = [normalize(os.path.join(self._projectPath, file)) for file in settings_dict["files"]]
 
         self._clangArgs = []
         self._clangArgs.extend(settings_dict["preprocessor"])
-        self._clangArgs.extend(list(map(lambda path: "-I" + os.path.join(self._projectPath, path),
+        self._clangArgs.extend(list(map(lambda path: "-I" + normalize(os.path.join(self._projectPath, path)),
                                         settings_dict["-Ipaths"])))
+        self._keepPaths = [os.path.normpath(os.path.join(self._projectPath, path))
+                           for path in settings_dict.get("keepPaths", [])]
         settings_file.close()
 
+    @staticmethod
+    def get_batch_settings(paths):
+        # settings file is json object, manifest is json list of settings files (relative to manifest)
+        settings = list()
+        for path in paths:
+            with open(path, mode="r") as json_file:
+                content = json.load(json_file)
+            if isinstance(content, list):
+                settings.extend(os.path.join(os.path.dirname(path), project) for project in content)
+            else:
+                settings.append(path)
+        return settings
+
+    @classmethod
+    def share_index(cls):
+        # all parsers created later use the same index (libclang is loaded once)
+        if cls._parserIndex is None:
+            cls._parserIndex = Index.create()
+
     def initialize_defaults(self):
+        # options unit is parsed with to get any kind (see get_parse_options)
         self._clangOptions = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD | \
                              TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
 
-    def parse_next_file(self):
+    def get_parse_options(self, kinds=None):
+        # detailed preprocessing record is expensive: only for macros
+        # kept and cached units are reused to get any kinds, so they are always parsed with full options
+        if self._units is not None or self._astCache is not None or kinds is None or CursorKind.MACRO_DEFINITION in kinds:
+            return self._clangOptions
+        return TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+
+    def parse_next_file(self, kinds=None):
         for next_file in self._parseFiles:
-            print('   {}'.format(next_file))
-            self.currentUnit = self._parserIndex.parse(next_file, args=self._clangArgs, options=self._clangOptions)
-            yield self.currentUnit
+            with profiler.span(next_file, "unit"):  # parsing plus whatever is done with unit
+                yield self.parse_file(next_file, kinds)
+            self.dispose_unit(next_file)
+
+    def parse_file(self, file, kinds=None):
+        print('   {}'.format(file))
+        if self._parserIndex is None:  # libclang is loaded only if something is really parsed (or index is shared)
+            self._parserIndex = Index.create()
+
+        with profiler.span("parse"):
+            if self._units is None and self._astCache is None:
+                self.currentUnit = self.parse_source(file, self.get_parse_options(kinds))
+            else:
+                self.currentUnit = self.get_unit(file)
+        if self.incremental and file not in self._sources:
+            self.add_sources(file, [inclusion.include.name for inclusion in self.currentUnit.get_includes()])
+        return self.currentUnit
+
+    def parse_source(self, file, options):
+        # fast parse is useless for kept headers: they are met only as #include'd files
+        if self.fastParse and not len(self._keepPaths):
+            unit = self._parserIndex.parse(file, args=self._clangArgs,
+                                           options=options | TranslationUnit.PARSE_INCOMPLETE | PARSE_KEEP_GOING | PARSE_SINGLE_FILE)
+            if not any(diagnostic.severity >= Diagnostic.Error for diagnostic in unit.diagnostics):
+                return unit
+            profiler.count("fast parse fallbacks")  # e.g. unknown type names declared in #include'd files
+        return self._parserIndex.parse(file, args=self._clangArgs, options=options)
+
+    def keep_units(self):
+        # parsed units are kept in memory to be reused or reparsed when the same file is parsed again (see watch)
+        # otherwise only one unit is alive at a time: every pass loads cached unit or parses file once again
+        if self._units is None:
+            self._units = dict()
+
+    def dispose_unit(self, file):
+        # handled instances don't refer to walked unit, so it is freed as soon as parser forgets it
+        self.currentUnit = None
+
+    def get_unit(self, file):
+        # kept unit, saved unit from ast cache or parsed one (saved to ast cache then)
+        kept = self._units if self._units is not None else dict()
+        unit, modified, is_from_source = kept.get(file, (None, None, False))
+
+        # already parsed and neither file nor any of included files was changed
+        if unit is not None and modified == self.get_modification_times(modified):
+            return unit
+
+        if unit is not None and is_from_source:
+            unit.reparse()   # much cheaper than parsing, unchanged files are reused
+        else:
+            unit = self._astCache.load(file, self._parserIndex) if self._astCache is not None else None
+            is_from_source = unit is None
+            if is_from_source:
+                unit = self.parse_source(file, self._clangOptions)
+                if self._astCache is not None:
+                    self._astCache.store(file, unit)
+                    self._astCache.evict()
+
+        if self._units is not None:
+            files = [file] + [inclusion.include.name for inclusion in unit.get_includes()]
+            self._units[file] = (unit, self.get_modification_times(files), is_from_source)
+        return unit
+
+    @staticmethod
+    def get_modification_times(files):
+        modified = dict()
+        for file in files:
+            try:
+                modified[file] = os.stat(file).st_mtime_ns
+            except OSError:
+                modified[file] = None
+        return modified
+
+    def get_tokens(self, extent):
+        # spellings of tokens of current unit within extent (macro definition: a few tokens are read)
+        profiler.count("extents tokenized")
+        return [token.spelling for token in TokenGroup.get_tokens(self.currentUnit, extent)]
+
+    def clear_registry(self):
+        # forget handled cursors, to handle the same unit once again
+        self._cursorRegistrator = set()
+        self._generatedFiles = dict()
+        self._keptFiles = list()
 
     @property
     def project(self):
@@ -58,6 +242,95 @@ class Parser:
     def files(self):
         return self._parseFiles
 
+    @property
+    def generated_files(self):
+        # kept headers go first: parsed files depend on them
+        return self._keptFiles + self._parseFiles
+
+    @property
+    def worker_args(self):
+        # the same settings for parser created in another process
+        return self.get_cli_args(self.settingsPath)
+
+    def get_project_args(self, settings_path):
+        # parser of batch project: the same options, its own settings (paths in it are relative to it)
+        cli_args = self.get_cli_args(settings_path) + ["--jobs", str(self.jobs)]
+        if not self.settingsRelative:
+            cli_args.append("--settings-relative")
+        if self.cacheDir is not None:
+            cli_args.extend(["--cache", self.cacheDir, "--cache-size", str(self.cacheSize // (1024 * 1024))])
+        return cli_args
+
+    def get_cli_args(self, settings_path):
+        cli_args = ["--settings", settings_path]
+        if self.astCacheDir is not None:
+            cli_args.extend(["--ast-cache", self.astCacheDir, "--cache-size", str(self.cacheSize // (1024 * 1024))])
+        if self.incremental:
+            cli_args.append("--incremental")
+        if self.lazyBinding:
+            cli_args.append("--lazy-binding")
+        if self.package:
+            cli_args.append("--package")
+        if self.fastParse:
+            cli_args.append("--fast-parse")
+        if self.settingsRelative:
+            cli_args.append("--settings-relative")
+        return cli_args
+
+    @property
+    def output_package(self):
+        return os.path.splitext(self.outputFile)[0]
+
+    @property
+    def cache_key_args(self):
+        # everything besides files contents which affects handling of parsed file
+        # absolute project path isn't: handled file is shared by projects (e.g. of batch) parsing it the same way
+        # relative one is a part of files names in handled instances, as well as directory it is relative to
+        root = None if os.path.isabs(self._projectPath) else (os.getcwd(), self._projectPath)
+        kept_listed = [file for file in self._parseFiles if self.is_in_keep_paths(file)]   # generated in own unit only
+        return root, self._clangArgs, self._clangOptions, self._keepPaths, kept_listed, self.fastParse
+
+    @property
+    def sources(self):
+        return self._sources
+
+    @property
+    def sources_context(self):
+        # everything besides files contents which affects handled declarations and their order
+        return repr((self.cache_key_args, self._parseFiles))
+
+    def add_sources(self, file, included):
+        # files included by parsed file (might be parsed in another process or loaded from cache)
+        self._sources[file] = set(included)
+
+    @property
+    def kept_files(self):
+        return self._keptFiles
+
+    def add_kept_files(self, files):
+        # kept headers met while parsing in another process
+        for file in files:
+            if file not in self._keptFiles:
+                self._keptFiles.append(file)
+            self._generatedFiles[file] = True
+
+    def is_generated_file(self, file_name):
+        if file_name == self.currentUnit.spelling:
+            return True
+
+        is_generated = self._generatedFiles.get(file_name)
+        if is_generated is None:
+            is_generated = self.is_in_keep_paths(file_name)
+            is_listed = os.path.normpath(file_name) in map(os.path.normpath, self._parseFiles)
+            if is_generated and not is_listed:
+                self._keptFiles.append(file_name)
+            self._generatedFiles[file_name] = is_generated
+        return is_generated
+
+    def is_in_keep_paths(self, file_name):
+        directory = os.path.dirname(os.path.normpath(file_name))
+        return any(directory == path or directory.startswith(path + os.sep) for path in self._keepPaths)
+
     @staticmethod
     def initialize_argument_parser():
         parser = argparse.ArgumentParser()
@@ -66,15 +339,110 @@ class Parser:
                             type=str,
                             default='./settings.json',
                             help="path to .json settings file")
+        parser.add_argument('--settings-relative',
+                            dest="settingsRelative",
+                            action="store_true",
+                            help="resolve relative project and output of settings against settings file directory "
+                                 "(always so for --batch projects)")
+        parser.add_argument('--single-pass',
+                            dest="singlePass",
+                            action="store_true",
+                            help="parse every file once instead of separate typedefs pass")
+        parser.add_argument('-j', '--jobs',
+                            dest="jobs",
+                            type=int,
+                            default=1,
+                            help="number of processes to parse files in, implies single pass")
+        parser.add_argument('--cache',
+                            dest="cacheDir",
+                            type=str,
+                            default=None,
+                            help="directory to cache handled declarations of parsed files in, implies single pass")
+        parser.add_argument('--cache-size',
+                            dest="cacheSize",
+                            type=int,
+                            default=512,
+                            help="cache directory size limit (or memory limit of server caches), MB")
+        parser.add_argument('--ast-cache',
+                            dest="astCacheDir",
+                            type=str,
+                            default=None,
+                            help="directory to save parsed translation units in, to load them instead of parsing")
+        parser.add_argument('--watch',
+                            dest="watchInterval",
+                            type=float,
+                            nargs='?',
+                            const=1.0,
+                            default=None,
+                            help="keep running and regenerate wrapper when parsed files are changed, check every N seconds")
+        parser.add_argument('--incremental',
+                            dest="incremental",
+                            action="store_true",
+                            help="reuse text of output sections whose source files weren't changed; any change of "
+                                 "typedefs, enums or structures regenerates all sections resolved with them, "
+                                 "output file is rewritten as a whole")
+        parser.add_argument('--stream',
+                            dest="stream",
+                            action="store_true",
+                            help="generate every parsed file as soon as it is resolved, without keeping declarations")
+        parser.add_argument('--lazy-binding',
+                            dest="lazyBinding",
+                            action="store_true",
+                            help="generated functions are bound on first access, Class(prebind=True) binds all at once")
+        parser.add_argument('--package',
+                            dest="package",
+                            action="store_true",
+                            help="generate package (output without extension) with module for every generated file")
+        parser.add_argument('--profile',
+                            dest="profilePath",
+                            type=str,
+                            nargs='?',
+                            const="profile.json",
+                            default=None,
+                            help="save timings of phases and units and counters to json report")
+        parser.add_argument('--profile-trace',
+                            dest="tracePath",
+                            type=str,
+                            default=None,
+                            help="with --profile, save phases and units as chrome trace events as well")
+        parser.add_argument('--fast-parse',
+                            dest="fastParse",
+                            action="store_true",
+                            help="parse every file without #include'd files, fully if its declarations aren't resolved")
+        parser.add_argument('--batch',
+                            dest="batch",
+                            type=str,
+                            nargs='+',
+                            default=None,
+                            help="settings files (or json manifests listing them) of projects to generate in one run")
+        parser.add_argument('--serve',
+                            dest="serveSocket",
+                            type=str,
+                            nargs='?',
+                            const="",
+                            default=None,
+                            help="accept generation requests of client.py on unix socket (default one if not given), "
+                                 "keeping libclang, handled files and resolved types between them")
         return parser
 
     def register_cursor(self, cursor):
         # transparent for first typedefs iteration
         if cursor.type == CursorKind.TYPEDEF_DECL:
             return True
-        # avoid double handling
-        elif cursor not in self._cursorRegistrator:
-            self._cursorRegistrator.append(cursor)
+        # avoid double handling: hashed key instead of comparing cursors one by one (every comparison is FFI call)
+        return self.register_key(self.get_cursor_key(cursor))
+
+    def register_key(self, key):
+        profiler.count("registry lookups")
+        if key not in self._cursorRegistrator:
+            self._cursorRegistrator.add(key)
             return True
         else:
             return False
+
+    @staticmethod
+    def get_cursor_key(cursor):
+        # stable identity of declaration: the same for cursor met by visitor and for nested declaration met as field
+        location = cursor.location
+        file = location.file.name if location.file else None
+        return file, location.offset, cursor.kind.value
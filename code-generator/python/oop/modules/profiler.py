@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from clang.cindex import conf
+
+
+class Profiler:
+
+    # wall time of phases and translation units, counters, libclang calls (see --profile)
+    # disabled profiler does nothing: spans and counters are skipped
+    # one profiler is common for the process: measurements of several threads (e.g. sessions) are summed up under lock
+
+    # libclang function name part -> category of call, the first matched is taken
+    ffiCategories = (
+        ("Token", "tokens"), ("tokenize", "tokens"),
+        ("Location", "locations"), ("Extent", "locations"), ("Range", "locations"), ("File", "locations"),
+        ("TranslationUnit", "units"), ("Inclusions", "units"), ("Index", "units"),
+        ("Type", "types"), ("Typedef", "types"),
+        ("String", "strings"),
+        ("Cursor", "cursors"), ("visitChildren", "cursors"),
+    )
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = dict()
+        self.phases = dict()        # phase -> seconds
+        self.units = dict()         # translation unit -> seconds
+        self.projects = dict()      # project settings -> seconds, in batch mode
+        self.ffiCalls = dict()      # libclang function -> number of calls
+        self._events = list()       # chrome trace events
+        self._start = None
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.perf_counter()
+        if isinstance(conf.lib, CountingLibrary):
+            conf.lib.calls, conf.lib.lock = self.ffiCalls, self._lock    # calls are counted by profiler enabled last
+        else:
+            conf.lib = CountingLibrary(conf.lib, self.ffiCalls, self._lock)
+
+    def reset(self):
+        # forget everything measured before (e.g. for previous request to generation server), stop counting
+        if isinstance(conf.lib, CountingLibrary):
+            conf.lib = conf.lib._lib
+        self.__init__()
+
+    def count(self, counter, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name, category="phase"):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            spans = {"unit": self.units, "project": self.projects}.get(category, self.phases)
+            with self._lock:
+                spans[name] = spans.get(name, 0) + duration
+                self._events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(),
+                                     "tid": threading.get_native_id(),
+                                     "ts": round((start - self._start) * 1e6), "dur": round(duration * 1e6)})
+
+    def get_measurements(self):
+        # everything measured in this process (e.g. in worker one), to be merged into profile of another process
+        return {"start": self._start, "counters": self.counters, "phases": self.phases, "units": self.units,
+                "ffiCalls": self.ffiCalls, "events": self._events}
+
+    def merge(self, measurements):
+        # spans and counters are summed up, trace events keep their process id (perf_counter is system-wide)
+        offset = round((measurements["start"] - self._start) * 1e6)
+        with self._lock:
+            for name in ("counters", "phases", "units", "ffiCalls"):
+                merged = getattr(self, name)
+                for key, value in measurements[name].items():
+                    merged[key] = merged.get(key, 0) + value
+            self._events.extend(dict(event, ts=event["ts"] + offset) for event in measurements["events"])
+
+    def get_ffi_category(self, function):
+        for part, category in self.ffiCategories:
+            if part in function:
+                return category
+        return "other"
+
+    def report(self, **counters):
+        ffi = dict()
+        for function, calls in self.ffiCalls.items():
+            category = self.get_ffi_category(function)
+            ffi[category] = ffi.get(category, 0) + calls
+        return {
+            "totalSeconds": time.perf_counter() - self._start,
+            "phases": self.phases,
+            "units": dict(sorted(self.units.items(), key=lambda unit: unit[1], reverse=True)),  # the slowest first
+            "projects": self.projects,
+            "counters": dict(self.counters, **counters),
+            "ffiCalls": dict(ffi, total=sum(self.ffiCalls.values())),
+            "ffiFunctions": dict(sorted(self.ffiCalls.items(), key=lambda function: function[1], reverse=True)),
+        }
+
+    def save(self, report_path, trace_path=None, **counters):
+        with open(report_path, mode="w") as report_file:
+            json.dump(self.report(**counters), report_file, indent=2)
+        if trace_path is not None:
+            with open(trace_path, mode="w") as trace_file:
+                json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, trace_file)
+
+
+class CountingLibrary:
+
+    # stands for loaded libclang: every function call is counted
+
+    def __init__(self, lib, calls, lock):
+        self._lib = lib
+        self.calls = calls
+        self.lock = lock
+
+    def __getattr__(self, name):
+        function = getattr(self._lib, name)
+        if not callable(function):
+            return function
+
+        def counted(*args):
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+            return function(*args)
+
+        setattr(self, name, counted)    # the next access doesn't get here
+        return counted
+
+
+profiler = Profiler()   # common for all modules of one process
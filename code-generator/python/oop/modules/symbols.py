@@ -0,0 +1,28 @@
+class SymbolTable:
+
+    # names of handled declarations: hashed index for every kind
+    # dictionaries are used as ordered sets (order of registration must be the same from run to run)
+
+    def __init__(self):
+        self.aliases = dict()           # typedef alias -> underlying
+        self.underlyings = dict()       # underlying -> typedef aliases, the first one is preferred
+        self.canonicals = dict()        # typedef alias -> canonical underlying
+        self.enums = dict()             # enum names
+        self.structs_unions = dict()    # structure or union names
+        self.incomplete = dict()        # incomplete structure or union names
+
+    def add_typedef(self, alias, underlying):
+        self.aliases[alias] = underlying
+        self.underlyings.setdefault(underlying, list()).append(alias)
+
+    def add_enum(self, name):
+        self.enums[name] = None
+
+    def add_struct_union(self, name):
+        self.structs_unions[name] = None
+
+    def set_incomplete(self, name, is_incomplete):
+        if is_incomplete:
+            self.incomplete[name] = None
+        else:
+            self.incomplete.pop(name, None)
@@ -0,0 +1,43 @@
+from .profiler import profiler
+
+
+def walk(root, kinds=None, file_filter=None, skip=None):
+
+    """
+    iterative (explicit stack) depth-first traversal of AST, the same order as recursive visitor has
+    yields (cursor, depth, parent), children of root have depth 0
+
+      - kinds = only cursors of these kinds are yielded, the others are traversed anyway
+      - file_filter = predicate for cursor file name, only cursors from accepted files are yielded
+      - skip = predicate (cursor, depth), if True, cursor is neither yielded nor traversed
+    """
+
+    is_counted = profiler.enabled
+    stack = [(iter(root.get_children()), 0, root)]
+    while stack:
+        children, depth, parent = stack[-1]
+        cursor = next(children, None)
+        if cursor is None:
+            stack.pop()
+            continue
+        if is_counted:
+            profiler.count("cursors visited")
+
+        if skip is not None and skip(cursor, depth):
+            if is_counted:
+                profiler.count("subtrees pruned")
+            continue
+
+        if is_accepted(cursor, kinds, file_filter):
+            yield cursor, depth, parent
+
+        stack.append((iter(cursor.get_children()), depth + 1, cursor))
+
+
+def is_accepted(cursor, kinds, file_filter):
+    if kinds is not None and cursor.kind not in kinds:
+        return False
+    if file_filter is not None:
+        file = cursor.location.file  # can't get file from some cursors which points to system entities
+        return file is not None and file_filter(file.name)
+    return True
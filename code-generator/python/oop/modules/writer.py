@@ -1,24 +1,60 @@
 from .kinds import Kinds, CommonTypeData
+from .cache import ContentHashes
+from .profiler import profiler
 from clang.cindex import CursorKind
 from datetime import datetime
+import io
+import os
+import re
+import stat
+import ast
+import keyword
+import tempfile
+import json
+import pickle
+import hashlib
 
 
-class Writer(Kinds):
+class Writer(Kinds, ContentHashes):
 
-    def __init__(self):
+    def __init__(self, incremental=False, stream=False, lazy_binding=False):
         super().__init__()
         self.containers = dict()
+        self._containerKeys = dict()        # cursor kind -> key of container
         for kind in self.cursorKinds.keys():
             self.containers[kind] = list()
+            for k in kind:
+                self._containerKeys[k] = kind
+        self._buckets = dict()              # (file, key of container) -> instances, in order of insertion
+
+        # incremental generation: text of sections which instances weren't changed is taken from previous output
+        self.incremental = incremental
+        self._previousOutput = None
+        self._previousSections = dict()     # section -> (digest, start, end) in previous output
+        self._sections = dict()
+        self._tablesDigest = None           # digest of class-level tables, see get_tables_digest
+        self._sources = dict()              # parsed file -> files it includes, see set_sources
+        self._sourcesContext = ""           # parsing arguments and files order
+        self._sourcesDigests = dict()       # generated file -> digest of files its declarations depend on
+
+        # lazy binding: functions are bound on first access instead of all at once when Class is created
+        self.lazyBinding = lazy_binding
+
+        # streaming: resolved instances are generated at once into spool files, output is assembled from them
+        self.stream = stream
+        self._pending = list()              # handled instances not generated yet
+        self._spools = None                 # temporary files: (types, functions)
+        self._chunks = dict()               # (file, key of container) -> [(spool, start, end)]
 
     def update_containers(self, type_instance: CommonTypeData):
 
-        key = None
-        for key in self.containers:
-            if type_instance.cursor.kind in key:
-                break
+        if self.stream:
+            self._pending.append(type_instance)
+            return
 
+        key = self._containerKeys[type_instance.kind]
         self.containers[key].append(type_instance)
+        self._buckets.setdefault((type_instance.location, key), list()).append(type_instance)
 
         # TODO: remove after testing
         # parsed_instances_names = [instance.name for instance in self.containers[type_instance.cursor.kind]]
@@ -31,29 +67,252 @@ class Writer(Kinds):
         # else:
         #     self.containers[type_instance.cursor.kind][parsed_instances_names.index(type_instance.name)] = type_instance
 
+    def flush_stream(self, resolved_files=None):
+        # generate pending instances from given files (all if None), they must be resolved already
+        if self._spools is None:
+            self._spools = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+
+        buckets = dict()
+        pending = list()
+        for instance in self._pending:
+            if resolved_files is None or instance.location in resolved_files:
+                buckets.setdefault((instance.location, self._containerKeys[instance.kind]), list()).append(instance)
+            else:
+                pending.append(instance)
+        self._pending = pending
+
+        for bucket, instances in buckets.items():
+            spool = self._spools[1 if bucket[1] == (CursorKind.FUNCTION_DECL, ) else 0]
+            generated = io.StringIO()   # one write to spool instead of many small ones
+            for instance in instances:
+                self.generate_instance(instance, generated)
+            start = spool.seek(0, io.SEEK_END)
+            spool.write(generated.getvalue().encode())
+            self._chunks.setdefault(bucket, list()).append((spool, start, spool.tell()))
+
     def generate_output(self, output_file: str, parsed_files: list, prefix: str):
-        with open(output_file, mode="w") as wrapper:
+        if self.stream:
+            self.flush_stream()
+
+        if not self.incremental:
+            self.write_atomically(output_file, lambda wrapper: self.write_output(wrapper, parsed_files, prefix))
+            return
+
+        self.load_sections(output_file)
+        wrapper = io.StringIO()     # position in text is necessary to know where every section is
+        self.write_output(wrapper, parsed_files, prefix)
+        self.write_atomically(output_file, lambda output: output.write(wrapper.getvalue()))
+        self.save_sections(output_file, wrapper.getvalue())
+
+    @staticmethod
+    def write_atomically(output_file, write):
+        # output is never seen half-written: it is written to temporary file which then replaces output
+        directory = os.path.dirname(os.path.abspath(output_file))
+        with tempfile.NamedTemporaryFile(mode="w", dir=directory, prefix=".", suffix=".tmp", delete=False) as temp:
+            try:
+                write(temp)
+            except BaseException:
+                temp.close()
+                os.remove(temp.name)
+                raise
+        os.chmod(temp.name, Writer.get_output_mode(output_file))
+        profiler.count("bytes written", os.path.getsize(temp.name))
+        os.replace(temp.name, output_file)
+
+    @staticmethod
+    def get_output_mode(output_file):
+        # replaced file keeps its mode, new one gets mode open() would create it with (temporary file is private)
+        try:
+            return stat.S_IMODE(os.stat(output_file).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
+    def write_output(self, wrapper, parsed_files, prefix):
+        self.write_beginning(wrapper)
+        self.write_kinds(wrapper, parsed_files, prefix, [kind for keys in Kinds.cursorKinds for kind in keys if kind != CursorKind.FUNCTION_DECL])
+        self.write_functions_class(wrapper, parsed_files, prefix)
+
+    def generate_package(self, package_dir: str, parsed_files: list, prefix: str):
+        # module for every parsed file and module with functions class, package imports them on first access
+        if self.stream:
+            self.flush_stream()
+        os.makedirs(package_dir, exist_ok=True)
+
+        exported = dict()   # name -> module, declared later overrides declared earlier (as in one output file)
+        modules = list()
+        for current in parsed_files:
+            module = self.get_module_name(current[len(prefix)::] if current.startswith(prefix) else current, modules)
+            body = io.StringIO()
+            self.write_kinds(body, [current], prefix, [kind for keys in Kinds.cursorKinds for kind in keys if kind != CursorKind.FUNCTION_DECL])
+            self.write_module(package_dir, module, body.getvalue(), exported)
+            modules.append(module)
+
+        body = io.StringIO()
+        self.write_functions_class(body, parsed_files, prefix)
+        self.write_module(package_dir, "_library", body.getvalue(), exported)
+        modules.append("_library")
+
+        self.write_atomically(os.path.join(package_dir, "__init__.py"),
+                              lambda wrapper: self.write_package_init(wrapper, exported, modules))
+
+    def write_module(self, package_dir, module, body, exported):
+        # names module uses but doesn't declare are imported from modules they were declared in
+        tree = ast.parse(body)
+        declared = set()
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                declared.add(node.name)
+            elif isinstance(node, ast.Assign):
+                declared.update(target.id for target in node.targets if isinstance(target, ast.Name))
+        used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+        imports = dict()    # module -> names
+        for name in sorted(used - declared):
+            if name in exported:
+                imports.setdefault(exported[name], list()).append(name)
+
+        def write(wrapper):
             self.write_beginning(wrapper)
-            self.write_kinds(wrapper, parsed_files, prefix, [kind for keys in Kinds.cursorKinds for kind in keys if kind != CursorKind.FUNCTION_DECL])
-            self.write_functions_class(wrapper, parsed_files, prefix)
+            for imported_module, names in imports.items():
+                wrapper.write("from .{} import {}\n".format(imported_module, ", ".join(names)))
+            if len(imports):
+                wrapper.write("\n")
+            wrapper.write(body)
+
+        self.write_atomically(os.path.join(package_dir, module + ".py"), write)
+        for name in sorted(declared):
+            exported[name] = module
+
+    @staticmethod
+    def get_module_name(file, taken):
+        module = re.sub(r"\W", "_", os.path.splitext(os.path.normpath(file))[0]).strip("_") or "_header"
+        if module[0].isdigit() or keyword.iskeyword(module):
+            module = "_" + module
+        name, counter = module, 1
+        while name in taken or name == "_library":
+            name = "{}_{}".format(module, counter)
+            counter += 1
+        return name
 
     def write_kinds(self, wrapper, parsed_files, prefix, kinds):
         for current in parsed_files:
             wrapper.write("# +----------------------------------------------------------------------+\n")
-            wrapper.write("# +    {:<65} +\n".format(current[len(prefix)::]))
+            wrapper.write("# +    {:<65} +\n".format(current[len(prefix)::] if current.startswith(prefix) else current))
             wrapper.write("# +----------------------------------------------------------------------+\n\n")
 
-            for key, instances in self.containers.items():
+            for key in self.containers:
                 for kind in key:
                     if kind in kinds:
-                        from_current = [instance for instance in instances if instance.location == current]
-                        for instance in from_current:
-                            instance.generate(wrapper)
-                        if len(from_current):
+                        section = "{}#{}".format(current[len(prefix)::], self.cursorKinds[key])
+                        if self.stream:
+                            is_written = self.copy_chunks(wrapper, (current, key))
+                        else:
+                            from_current = self._buckets.get((current, key), [])
+                            self.write_section(wrapper, section, current, from_current)
+                            is_written = len(from_current)
+                        if is_written:
                             wrapper.write('\n')
                         break  # prevent generating the same container for every of several kinds in key
 
+    def write_section(self, wrapper, section, file, instances):
+        if not self.incremental:
+            for instance in instances:
+                self.generate_instance(instance, wrapper)
+            return
+        if not len(instances):
+            return
+
+        digest = self.get_section_digest(file, instances)
+        previous = self._previousSections.get(section)
+        start = wrapper.tell()
+        if previous is not None and previous[0] == digest:
+            wrapper.write(self._previousOutput[previous[1]:previous[2]])
+        else:
+            for instance in instances:
+                self.generate_instance(instance, wrapper)
+        self._sections[section] = (digest, start, wrapper.tell())
+
+    def generate_instance(self, instance, wrapper):
+        if self.lazyBinding and instance.kind == CursorKind.FUNCTION_DECL:
+            instance.generate_prototype(wrapper)
+        else:
+            instance.generate(wrapper)
+
+    def copy_chunks(self, wrapper, bucket):
+        chunks = self._chunks.get(bucket, [])
+        for spool, start, end in chunks:
+            spool.seek(start)
+            wrapper.write(spool.read(end - start).decode())
+        return len(chunks)
+
+    def set_sources(self, sources, context):
+        # sections of incremental output are keyed on contents of files their declarations are handled from
+        self._sources = sources
+        self._sourcesContext = context
+
+    def get_section_digest(self, file, instances):
+        # contents of sources of declarations, plus tables for kinds which are resolved with them
+        # tables are taken as a whole: any typedef, enum or structure changed anywhere regenerates all such sections
+        digest = hashlib.sha256(self.get_sources_digest(file))
+        if any(instance.dependsOnTables for instance in instances):
+            digest.update(self.get_tables_digest())
+        return digest.hexdigest()
+
+    def get_sources_digest(self, file):
+        # declarations of file depend on file itself, files it includes and (as #include'd) on units including it
+        if file not in self._sourcesDigests:
+            files = {file}
+            for unit, included in self._sources.items():
+                if unit == file or file in included:
+                    files.add(unit)
+                    files.update(included)
+            if len(files) == 1 and file not in self._sources:  # unknown origin: any file might affect it
+                for unit, included in self._sources.items():
+                    files.add(unit)
+                    files.update(included)
+            digest = hashlib.sha256(self._sourcesContext.encode())
+            for source in sorted(files):
+                digest.update("{}:{}\n".format(source, self.get_file_hash(source)).encode())
+            self._sourcesDigests[file] = digest.digest()
+        return self._sourcesDigests[file]
+
+    def get_tables_digest(self):
+        # tables aren't changed while output is generated: pickled once per run (all entries, not only used ones)
+        if self._tablesDigest is None:
+            self._tablesDigest = hashlib.sha256(pickle.dumps(Kinds.get_tables(), protocol=pickle.HIGHEST_PROTOCOL)).digest()
+        return self._tablesDigest
+
+    def load_sections(self, output_file):
+        try:
+            with open(output_file, mode="r") as output, open(output_file + ".sections", mode="r") as sections_file:
+                previous_output = output.read()
+                sections = json.load(sections_file)
+        except (OSError, ValueError):
+            return
+
+        # output must be exactly the one sections were saved for, with the same binding of functions
+        if sections["digest"] == hashlib.sha256(previous_output.encode()).hexdigest() and \
+                sections.get("lazyBinding", False) == self.lazyBinding:
+            self._previousOutput = previous_output
+            self._previousSections = {section: tuple(value) for section, value in sections["sections"].items()}
+
+    def save_sections(self, output_file, output):
+        sections = {"digest": hashlib.sha256(output.encode()).hexdigest(), "lazyBinding": self.lazyBinding,
+                    "sections": self._sections}
+        with open(output_file + ".sections", mode="w") as sections_file:
+            json.dump(sections, sections_file, indent=2)
+
     def write_functions_class(self, wrapper, parsed_files, prefix):
+        if self.lazyBinding:
+            self.write_lazy_class_beginning(wrapper)
+            self.write_kinds(wrapper, parsed_files, prefix, [CursorKind.FUNCTION_DECL])
+            self.write_lazy_class_initialization(wrapper)
+            self.write_function_class_ending(wrapper)
+            self.write_lazy_class_binder(wrapper)
+            return
+
         self.write_function_class_beginning(wrapper)
         self.write_kinds(wrapper, parsed_files, prefix, [CursorKind.FUNCTION_DECL])
         self.write_function_class_ending(wrapper)
@@ -113,3 +372,84 @@ class Class(object):
     def get_version():
 """)
         wrapper.write('        return "{}" \n'.format(generated))
+
+    @staticmethod
+    def write_lazy_class_beginning(wrapper):
+        wrapper.write("\n")
+        wrapper.write("# +----------------------------------------------------------------------+\n")
+        wrapper.write("# +    {:<65} +\n".format("Functions class"))
+        wrapper.write("# +----------------------------------------------------------------------+\n")
+        wrapper.write("""
+class Class(object):
+    _instance = None
+    _initialized = False
+    _lib = None
+
+    # function name -> (restype, argtypes), function is bound on first access (see __getattr__)
+    _prototypes = {
+
+""")
+
+    @staticmethod
+    def write_lazy_class_initialization(wrapper):
+        wrapper.write("""    }
+    
+    def __new__(cls, *args, **kwargs):
+        if Class._instance is None:
+            Class._instance = object.__new__(cls)
+        return Class._instance 
+    
+    def __init__(self, libpath=None, prebind=False): 
+        if Class._initialized: 
+            pass 
+        else: 
+            if libpath is None: 
+                is_linux = lambda: True if platform.system() == "Linux" else False 
+                libpath = "./library.{0}".format("so" if is_linux() else "dll") 
+            Class._lib = cdll.LoadLibrary(libpath)
+            
+            # bind all functions at once, as eager wrapper does
+            if prebind:
+                for name in Class._prototypes:
+                    getattr(self, name)
+""")
+
+    @staticmethod
+    def write_lazy_class_binder(wrapper):
+        wrapper.write("""
+    def __getattr__(self, name):
+        prototype = Class._prototypes.get(name)
+        if prototype is None or Class._lib is None:
+            raise AttributeError(name)
+        function = getattr(Class._lib, name)
+        function.restype, function.argtypes = prototype
+        setattr(self, name, function)  # cached: the next access doesn't get here
+        return function
+""")
+
+    @staticmethod
+    def write_package_init(wrapper, exported, modules):
+        wrapper.write("#!/usr/bin/python3\n")
+        wrapper.write("import importlib\n\n")
+        wrapper.write("# name -> module it is declared in, module is imported on first access to any of its names\n")
+        wrapper.write("_exports = {\n")
+        for name, module in exported.items():
+            wrapper.write("    \"{}\": \"{}\",\n".format(name, module))
+        wrapper.write("}\n\n")
+        wrapper.write("_modules = [{}]\n".format(", ".join("\"{}\"".format(module) for module in modules)))
+        wrapper.write("""
+
+def __getattr__(name):
+    if name in _modules:
+        return importlib.import_module("." + name, __name__)
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    globals()[name] = value     # cached: the next access doesn't get here
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | set(_modules))
+""")
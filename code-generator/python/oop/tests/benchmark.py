@@ -0,0 +1,217 @@
+# benchmark of generator stages on synthetic headers
+#   python benchmark.py --structs 2000 --macros 5000 --functions 3000 --output results.json
+#   python benchmark.py ... --compare results.json    (fails if any stage is slower than threshold)
+
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+import io
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import contextlib
+from generator import traverse_ast, resolve_types
+from modules import Parser, Writer, Kinds, CommonTypeData
+from clang.cindex import CursorKind
+
+
+# +------------------------------------------------------+
+# +     SYNTHETIC HEADERS                                +
+# +------------------------------------------------------+
+
+
+def generate_headers(directory, structs, typedef_depth, macros, functions, files):
+    """
+    headers with given number of declarations, split between files:
+      - typedef chain bench_t0 -> ... -> bench_t<depth> (in the first file, included by others)
+      - structures with nested anonymous union, pointer to itself and callback field
+      - macros of all kinds generator handles
+      - functions with structure pointers and callbacks as arguments
+    returns list of files names relative to directory
+    """
+
+    names = ["bench_{}.h".format(number) for number in range(files)]
+    for number, name in enumerate(names):
+        with open(os.path.join(directory, name), mode="w") as header:
+            header.write("#ifndef BENCH_{0}_H\n#define BENCH_{0}_H\n\n".format(number))
+            if number:
+                header.write('#include "bench_0.h"\n\n')
+            else:
+                header.write("typedef int bench_t0;\n")
+                for depth in range(1, typedef_depth + 1):
+                    header.write("typedef bench_t{} bench_t{};\n".format(depth - 1, depth))
+                header.write("\n")
+
+            for i in range(number, macros, files):
+                header.write("#define BENCH_MACRO_{} {}\n".format(i, "({})".format(i) if i % 2 else i))
+            header.write("\n")
+
+            for i in range(number, structs, files):
+                header.write("typedef int (*bench_cb_{0})(struct bench_s{0}* s, int value);\n".format(i))
+                header.write("typedef struct bench_s{} {{\n".format(i))
+                header.write("    int id;\n")
+                header.write("    bench_t{} value;\n".format(typedef_depth))
+                header.write("    union {\n        unsigned int as_uint;\n        char as_bytes[4];\n    };\n")
+                header.write("    struct bench_s{}* next;\n".format(i))
+                header.write("    bench_cb_{} callback;\n".format(i))
+                header.write("}} bench_s{};\n\n".format(i))
+
+            for i in range(number, functions, files):
+                s = i % structs if structs else None
+                if s is not None and s % files == number:
+                    header.write("int bench_function_{}(bench_s{}* s, bench_cb_{} cb, bench_t{} value);\n"
+                                 .format(i, s, s, typedef_depth))
+                else:
+                    header.write("int bench_function_{}(char* name, bench_t{} value);\n".format(i, typedef_depth))
+
+            header.write("\n#endif\n")
+    return names
+
+
+def write_settings(directory, files):
+    settings_path = os.path.join(directory, "settings.json")
+    settings = {"project": os.path.join(directory, ""), "files": files, "-Ipaths": ["."],
+                "preprocessor": [], "output": os.path.join(directory, "generated.py")}
+    with open(settings_path, mode="w") as settings_file:
+        json.dump(settings, settings_file, indent=2)
+    return settings_path
+
+
+# +------------------------------------------------------+
+# +     STAGES                                           +
+# +------------------------------------------------------+
+
+
+class Stages:
+
+    # wall time and peak resident memory after every stage
+
+    def __init__(self):
+        self.results = dict()   # stage -> {"seconds": ..., "maxrssKb": ...}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        yield
+        self.results[stage] = {"seconds": time.perf_counter() - start,
+                               "maxrssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_once(settings_path):
+    Kinds.reset()
+    CommonTypeData.ctypes.hits = CommonTypeData.ctypes.misses = 0
+    parser = Parser(["--settings", settings_path])
+    parser.keep_units()     # units parsed once in the first stage, the others reuse them
+    writer = Writer()
+    stages = Stages()
+    kinds = [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key]
+
+    with contextlib.redirect_stdout(io.StringIO()):     # files names and warnings
+        with stages.measure("parse"):
+            for file in parser.files:
+                parser.parse_file(file)
+        with stages.measure("typedefs"):
+            traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
+        with stages.measure("traversal"):
+            instances = traverse_ast(parser, writer, kinds)
+        with stages.measure("resolve"):
+            resolve_types(instances)
+        with stages.measure("output"):
+            writer.generate_output(parser.outputFile, parser.generated_files, parser.project)
+
+    counters = {"instances": sum(len(instances) for instances in writer.containers.values()),
+                "outputBytes": os.path.getsize(parser.outputFile),
+                "ctypeHits": CommonTypeData.ctypes.hits,
+                "ctypeMisses": CommonTypeData.ctypes.misses}
+    return stages.results, counters
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        files = generate_headers(directory, args.structs, args.typedefDepth, args.macros, args.functions, args.files)
+        settings_path = write_settings(directory, files)
+
+        if args.traceMemory:
+            tracemalloc.start()
+        best = dict()
+        counters = None
+        for _ in range(args.repeat):
+            results, counters = run_once(settings_path)
+            for stage, result in results.items():
+                if stage not in best or result["seconds"] < best[stage]["seconds"]:
+                    best[stage] = result
+
+        report = {
+            "parameters": {"structs": args.structs, "typedefDepth": args.typedefDepth, "macros": args.macros,
+                           "functions": args.functions, "files": args.files, "repeat": args.repeat},
+            "stages": best,
+            "totalSeconds": sum(result["seconds"] for result in best.values()),
+            "maxrssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "counters": counters,
+        }
+        if args.traceMemory:
+            report["pythonPeakBytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return report
+
+
+def compare(report, baseline, threshold):
+    # stages slower than baseline more than threshold times
+    regressions = list()
+    for stage, result in report["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous is not None and previous["seconds"] > 0:
+            ratio = result["seconds"] / previous["seconds"]
+            print("   {:<10} {:8.3f} s  x{:.2f}".format(stage, result["seconds"], ratio))
+            if ratio > threshold:
+                regressions.append(stage)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="benchmark of generator stages on synthetic headers")
+    parser.add_argument('--structs', dest="structs", type=int, default=500, help="number of structures")
+    parser.add_argument('--typedef-depth', dest="typedefDepth", type=int, default=8, help="length of typedef chain")
+    parser.add_argument('--macros', dest="macros", type=int, default=1000, help="number of macros")
+    parser.add_argument('--functions', dest="functions", type=int, default=1000, help="number of functions")
+    parser.add_argument('--files', dest="files", type=int, default=4, help="number of headers declarations are split between")
+    parser.add_argument('--repeat', dest="repeat", type=int, default=3, help="the best time of repeats is taken")
+    parser.add_argument('--trace-memory', dest="traceMemory", action="store_true",
+                        help="report peak of python allocations as well (slows down all stages)")
+    parser.add_argument('--output', dest="output", type=str, default=None, help="json file to write results to")
+    parser.add_argument('--compare', dest="compare", type=str, default=None, help="json file with baseline results")
+    parser.add_argument('--threshold', dest="threshold", type=float, default=1.2,
+                        help="stage is regressed if it is slower than baseline this many times")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = run(args)
+
+    for stage, result in report["stages"].items():
+        print("{:<10} {:8.3f} s  {:>10} KB".format(stage, result["seconds"], result["maxrssKb"]))
+    print("{:<10} {:8.3f} s  {:>10} KB".format("total", report["totalSeconds"], report["maxrssKb"]))
+
+    if args.output is not None:
+        with open(args.output, mode="w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, mode="r") as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\ncompared to {}:".format(args.compare))
+        regressions = compare(report, baseline, args.threshold)
+        if len(regressions):
+            print("regressed: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
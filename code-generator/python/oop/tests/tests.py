@@ -5,10 +5,17 @@ import sys
 sys.path.append('..')
 
 
+import io
+import os
+import json
+import pickle
+import shutil
 import pytest
-from generator import is_appropriate
-from modules import Parser, Writer, Kinds, CommonTypeData, Enum, Struct
-from clang.cindex import CursorKind
+import generator
+from generator import is_appropriate, traverse_ast, stream_ast, traverse_units, resolve_types, generate_request, generate_wrapper, batch, watch
+from modules import Parser, Writer, Kinds, CommonTypeData, Typedef, Enum, StructUnion, SymbolTable, Profiler, ExtractionCache, MemoryCache, walk, profiler
+from client import get_default_socket
+from clang.cindex import CursorKind, TranslationUnit
 
 
 # +------------------------------------------------------+
@@ -16,54 +23,39 @@ from clang.cindex import CursorKind
 # +------------------------------------------------------+
 
 
-def visitor_traverse_ast(parent, parser, container):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, [CursorKind.MACRO_DEFINITION]):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            assert type_instance.__class__.__name__ == "Macro"
+def visit_kind(parent, parser, kind, class_name):
+    for cursor, _, _ in walk(parent, [kind]):
+        if is_appropriate(cursor, parser, [kind]):
+            type_instance = Kinds().get_instance(cursor, parser, Writer())
+            assert type_instance.__class__.__name__ == class_name
             type_instance.handle()
-            container[type_instance.name] = type_instance.value
-        visitor_traverse_ast(cursor, parser, container)
+            type_instance.resolve()
+            yield type_instance
+
+
+def visitor_traverse_ast(parent, parser, container):
+    for type_instance in visit_kind(parent, parser, CursorKind.MACRO_DEFINITION, "Macro"):
+        container[type_instance.name] = type_instance.value
 
 
 def visitor_typedef_parsing_iteration(parent, parser, container):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, [CursorKind.TYPEDEF_DECL]):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            assert type_instance.__class__.__name__ == "Typedef"
-            type_instance.handle()
-            container.append((type_instance.name, type_instance.underlying))
-        visitor_typedef_parsing_iteration(cursor, parser, container)
+    for type_instance in visit_kind(parent, parser, CursorKind.TYPEDEF_DECL, "Typedef"):
+        container.append((type_instance.name, type_instance.underlying))
 
 
 def visitor_handle_enums(parent, parser, container):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, [CursorKind.ENUM_DECL]):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            assert type_instance.__class__.__name__ == "Enum"
-            type_instance.handle()
-            container.append((type_instance.name, type_instance.constants))
-        visitor_typedef_parsing_iteration(cursor, parser, container)
+    for type_instance in visit_kind(parent, parser, CursorKind.ENUM_DECL, "Enum"):
+        container.append((type_instance.name, type_instance.constants))
 
 
 def visitor_handle_functions(parent, parser, container):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, [CursorKind.FUNCTION_DECL]):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            assert type_instance.__class__.__name__ == "Function"
-            type_instance.handle()
-            container.append((type_instance.name, type_instance.type, *type_instance.args))
-        visitor_handle_functions(cursor, parser, container)
+    for type_instance in visit_kind(parent, parser, CursorKind.FUNCTION_DECL, "Function"):
+        container.append((type_instance.name, type_instance.type, *type_instance.args))
 
 
 def visitor_handle_structures(parent, parser, container):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, [CursorKind.STRUCT_DECL]):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            assert type_instance.__class__.__name__ == "Struct"
-            type_instance.handle()
-            container.append((type_instance.name, *type_instance.fields.items()))
-        visitor_handle_structures(cursor, parser, container)
+    for type_instance in visit_kind(parent, parser, CursorKind.STRUCT_DECL, "StructUnion"):
+        container.append((type_instance.name, *type_instance.fields.items()))
 
 
 # +------------------------------------------------------+
@@ -94,11 +86,19 @@ def parse_typedefs(create_parser):
 
 @pytest.fixture
 def add_types_manually():
-    Enum._enums.append("enum EnumWithoutTypedef_test")
-    Enum._enums.append("enum EnumUnderlying_test")
-    Struct._structs.append("struct S_test")
-    Struct._structs.append("struct IncompleteStruct_test")
-    Struct._structs.append("struct S_callback_test")
+    Enum.symbols.add_enum("enum EnumWithoutTypedef_test")
+    Enum.symbols.add_enum("enum EnumUnderlying_test")
+    StructUnion.symbols.add_struct_union("struct S_test")
+    StructUnion.symbols.add_struct_union("struct IncompleteStruct_test")
+    StructUnion.symbols.add_struct_union("struct S_callback_test")
+
+
+@pytest.fixture
+def reset_tables():
+    # class-level tables are common for all tests: test starts with clean ones and doesn't leave its types
+    Kinds.reset()
+    yield
+    Kinds.reset()
 
 
 # +------------------------------------------------------+
@@ -106,26 +106,13 @@ def add_types_manually():
 # +------------------------------------------------------+
 
 
-def visitor_function(parent, parser, writer, kinds):
-    for cursor in parent.get_children():
-        if is_appropriate(cursor, parser.currentUnit.spelling, kinds):
-            type_instance = Kinds().get_instance(cursor, parser.currentUnit)
-            type_instance.handle()
-            writer.update_containers(type_instance)
-        visitor_function(cursor, parser, writer, kinds)
-
-
-def traverse_ast(parser, writer, kinds):
-    for translation_unit in parser.parse_next_file():
-        visitor_function(translation_unit.cursor, parser, writer, kinds)
-
-
 @pytest.fixture
 def parse_all(create_parser, create_writer):
     parser = create_parser
     writer = create_writer
     traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
-    traverse_ast(parser, writer, [kind for kind in Kinds.cursorKinds.keys() if kind != CursorKind.TYPEDEF_DECL])
+    kinds = [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key]
+    resolve_types(traverse_ast(parser, writer, kinds))
     return parser, writer
 
 
@@ -137,7 +124,7 @@ def parse_all(create_parser, create_writer):
 def test_context_parse_args(create_parser):
     parser = create_parser
     assert parser._projectPath == "./"
-    assert parser._parseFiles == ["./samples/include/header.h", "./samples/source.c"]
+    assert parser._parseFiles == ["./samples/include/header.h", "./samples/_source.c"]
     assert parser.outputFile == "generated.py"
     expected_clang_args = ["-D__linux__", "-U_WIN32", "-I./samples/include"]
     for arg in expected_clang_args:
@@ -178,8 +165,8 @@ def test_typedef_parsing_iteration(create_parser):
     assert ("EnumAlias_test", "enum EnumUnderlying_test") in container
     assert ('callback_test', 'int (int, int)') in container
     assert ('S_callback_test', 'struct S_callback_test') in container
-    # assert len(Typedef._aliases) == ...           # aliases have unique names
-    # assert len(Typedef._underlyings) == ...       # one type might have different aliases
+    # assert len(Typedef.symbols.aliases) == ...           # aliases have unique names
+    # assert len(Typedef.symbols.underlyings) == ...       # one type might have different aliases
 
 
 def test_manage_qualifiers():
@@ -225,6 +212,47 @@ def test_get_ctype():
     assert CommonTypeData.get_ctype('NonExistentType*') == 'POINTER(c_void_p)'  # plus warning message should appear
 
 
+def test_get_ctype_cache(reset_tables):
+    print()
+    assert CommonTypeData.get_ctype('CachedAlias_test*') == 'POINTER(c_void_p)'  # plus warning message should appear
+    Typedef._update_typedefs('CachedAlias_test', 'uint8_t')                       # cached result must be dropped
+    assert CommonTypeData.get_ctype('CachedAlias_test*') == 'POINTER(c_uint8)'
+    hits = CommonTypeData.ctypes.hits
+    assert CommonTypeData.get_ctype('CachedAlias_test*') == 'POINTER(c_uint8)'
+    assert CommonTypeData.ctypes.hits == hits + 1
+
+
+def test_unknown_type_warning(reset_tables, monkeypatch, capsys):
+    monkeypatch.setattr(CommonTypeData.ctypes, "maxSize", 1)
+    for spelling in ('Unknown_test*', 'Unknown_test', 'int', 'Unknown_test*'):     # the first entry is dropped
+        CommonTypeData.get_ctype(spelling)
+    assert capsys.readouterr().out.count("'Unknown_test'") == 1
+
+
+def test_typedef_canonicals(reset_tables):
+    print()
+    Typedef._update_typedefs('ChainC_test', 'ChainB_test')
+    Typedef._update_typedefs('ChainB_test', 'ChainA_test')      # declared after alias it is underlying for
+    Typedef._update_typedefs('ChainA_test', 'struct Chain_test')
+    assert Typedef.get_canonical_underlying('ChainC_test') == 'struct Chain_test'
+    assert Typedef.get_type('ChainC_test') == 'ChainA_test'
+    Typedef._update_typedefs('ChainA_test', 'ChainC_test')      # cyclic, plus warning message should appear
+    assert Typedef.get_canonical_underlying('ChainC_test') == 'ChainA_test'
+
+
+def test_symbol_table():
+    print()
+    symbols = SymbolTable()
+    symbols.add_typedef('Alias_test', 'struct S_test')
+    symbols.add_typedef('AnotherAlias_test', 'struct S_test')
+    symbols.add_struct_union('struct S_test')
+    symbols.set_incomplete('struct S_test', True)
+    symbols.set_incomplete('struct S_test', False)              # defined later
+    assert 'struct S_test' in symbols.structs_unions
+    assert 'struct S_test' not in symbols.incomplete
+    assert symbols.underlyings['struct S_test'] == ['Alias_test', 'AnotherAlias_test']    # the first one is preferred
+
+
 def test_handle_macros(create_parser):
     parser = create_parser
     container = {}
@@ -237,6 +265,20 @@ def test_handle_macros(create_parser):
     assert "MACRO_FUNC_test" not in container.keys()
 
 
+def test_macro_tokens(create_parser):
+    parser = create_parser
+    spellings = dict()
+    for translation_unit in parser.parse_next_file():
+        for cursor, _, _ in walk(translation_unit.cursor, [CursorKind.MACRO_DEFINITION]):
+            if cursor.spelling.startswith("MACRO_"):
+                spellings[cursor.spelling] = parser.get_tokens(cursor.extent)
+    assert spellings["MACRO_INT1_test"] == ["MACRO_INT1_test", "42"]
+    assert spellings["MACRO_INT2_test"] == ["MACRO_INT2_test", "(", "123", ")"]
+    assert spellings["MACRO_STR_test"] == ["MACRO_STR_test", '"string"']
+    assert spellings["MACRO_EMPTY_test"] == ["MACRO_EMPTY_test"]
+    assert spellings["MACRO_FUNC_test"] == ["MACRO_FUNC_test", "(", "arg", ")", "(", "arg", ")"]
+
+
 def test_handle_enums(parse_typedefs):
     parser = parse_typedefs
     container = []
@@ -280,9 +322,9 @@ def test_update_writer(parse_all):
     parser, writer = parse_all
     print()
     container = []
-    for kind, instances in writer.containers.items():
+    for instances in writer.containers.values():
         for instance in instances:
-            container.append((kind, instance.name))
+            container.append((instance.kind, instance.name))
 
     # all handlers work fine
     assert (CursorKind.TYPEDEF_DECL, 'u8_test') in container
@@ -305,3 +347,397 @@ def test_debug(parse_all):
     parser, writer = parse_all
     print()
     writer.generate_output(parser.outputFile, parser.files, parser.project)
+
+
+def test_compact_records(parse_all):
+    parser, writer = parse_all
+    print()
+    for instances in writer.containers.values():
+        for instance in instances:
+            assert instance.cursor is None and instance.parser is None      # unit isn't referred anymore
+            assert not hasattr(instance, '__dict__')
+            copy = pickle.loads(pickle.dumps(instance))
+            assert (copy.kind, copy.name, copy.location) == (instance.kind, instance.name, instance.location)
+
+
+def test_writer_buckets(parse_all):
+    parser, writer = parse_all
+    print()
+    for key, instances in writer.containers.items():
+        for file in parser.generated_files:
+            from_file = [instance for instance in instances if instance.location == file]
+            assert writer._buckets.get((file, key), []) == from_file     # the same order as in container
+
+
+def test_lazy_binding(parse_all):
+    parser, writer = parse_all
+    print()
+    writer.lazyBinding = True
+    output = io.StringIO()
+    writer.write_functions_class(output, parser.generated_files, parser.project)
+    compile(output.getvalue(), "generated.py", "exec")     # valid class body
+    assert '"FunctionDefault_test": (c_int32, [POINTER(c_int32), POINTER(c_char_p)]),' in output.getvalue()
+    assert "self.FunctionDefault_test = lib.FunctionDefault_test" not in output.getvalue()
+
+
+def test_package_output(parse_all, tmp_path):
+    parser, writer = parse_all
+    print()
+    writer.generate_package(str(tmp_path / "generated"), parser.generated_files, parser.project)
+    modules = [file.name for file in (tmp_path / "generated").iterdir()]
+    assert len(modules) == len(parser.generated_files) + 2     # plus functions module and package init
+    assert "samples_include_header.py" in modules and "_library.py" in modules
+    init = (tmp_path / "generated" / "__init__.py").read_text()
+    assert '"Class": "_library",' in init
+    assert '"HEADER_DEFINE_test": "samples_include_header",' in init
+
+
+def test_profiler(create_parser, tmp_path):
+    profiler = Profiler()
+    profiler.enable()
+    parser = create_parser
+    with profiler.span("traversal"):
+        for translation_unit in parser.parse_next_file():
+            profiler.count("units", 1)
+    profiler.save(str(tmp_path / "profile.json"), str(tmp_path / "trace.json"))
+    report = profiler.report()
+    assert "traversal" in report["phases"]
+    assert report["counters"]["units"] == len(parser.files)
+    assert report["ffiCalls"]["total"] > 0      # libclang calls are counted once profiler is enabled
+    assert (tmp_path / "trace.json").exists()
+
+
+def test_batch_settings(tmp_path):
+    (tmp_path / "manifest.json").write_text('["first/settings.json", "second/settings.json"]')
+    (tmp_path / "settings.json").write_text('{"project": "./"}')
+    settings = Parser.get_batch_settings([str(tmp_path / "manifest.json"), str(tmp_path / "settings.json")])
+    assert settings == [str(tmp_path / "first/settings.json"), str(tmp_path / "second/settings.json"),
+                        str(tmp_path / "settings.json")]
+    parser = Parser(["--batch", str(tmp_path / "manifest.json"), "--jobs", "2"])
+    assert parser.get_project_args(settings[0])[:2] == ["--settings", settings[0]]
+    assert "--jobs" in parser.get_project_args(settings[0])
+
+
+def test_batch_relative_paths(tmp_path):
+    shutil.copytree("samples", tmp_path / "library" / "samples")
+    with open("settings.json", mode="r") as settings_file:
+        settings = json.load(settings_file)     # project "./" and output "generated.py" are relative to settings file
+    (tmp_path / "library" / "settings.json").write_text(json.dumps(settings))
+    (tmp_path / "manifest.json").write_text('["library/settings.json"]')
+    print()
+    batch(Parser(["--batch", str(tmp_path / "manifest.json")]))
+    assert (tmp_path / "library" / "generated.py").exists()
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_batch_shared_headers(tmp_path, monkeypatch, jobs):
+    # both projects list the same header by different relative paths
+    (tmp_path / "shared").mkdir()
+    (tmp_path / "shared" / "common.h").write_text("struct Common_test { int value; };\n")
+    for name in ("first", "second"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "own.h").write_text("struct Own_{}_test {{ int value; }};\n".format(name))
+        (tmp_path / name / "settings.json").write_text(json.dumps({
+            "project": "./", "files": ["../shared/common.h", "own.h"], "-Ipaths": ["../shared"],
+            "preprocessor": [], "output": "generated.py"}))
+    (tmp_path / "manifest.json").write_text('["first/settings.json", "second/settings.json"]')
+
+    extracted = list()
+    extract_files = generator.extract_files
+    monkeypatch.setattr(generator, "extract_files",
+                        lambda parser, files, executor=None: extracted.extend(files) or extract_files(parser, files, executor))
+    print()
+    batch(Parser(["--batch", str(tmp_path / "manifest.json"), "--jobs", jobs]))
+    assert sorted(map(os.path.basename, extracted)) == ["common.h", "own.h", "own.h"]   # shared header is handled once
+    for name in ("first", "second"):
+        output = (tmp_path / name / "generated.py").read_text()
+        assert "struct_Common_test" in output and "struct_Own_{}_test".format(name) in output
+
+
+def test_output_mode(tmp_path):
+    output = tmp_path / "generated.py"
+    umask = os.umask(0o027)
+    try:
+        Writer.write_atomically(str(output), lambda stream: stream.write("# new"))
+    finally:
+        os.umask(umask)
+    assert output.stat().st_mode & 0o777 == 0o640     # umask is applied to new file
+    output.chmod(0o600)
+    Writer.write_atomically(str(output), lambda stream: stream.write("# replaced"))
+    assert output.stat().st_mode & 0o777 == 0o600     # replaced file keeps its mode
+    assert output.read_text() == "# replaced"
+
+
+def test_stream_output(parse_all):
+    parser, writer = parse_all
+    print()
+    output = io.StringIO()
+    writer.write_output(output, parser.generated_files, parser.project)
+
+    Kinds.reset()
+    parser = Parser(["--settings", "settings.json", "--stream"])
+    writer = Writer(stream=True)
+    traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
+    stream_ast(parser, writer, [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key])
+    writer.flush_stream()
+    streamed = io.StringIO()
+    writer.write_output(streamed, parser.generated_files, parser.project)
+    assert streamed.getvalue().split('return "')[0] == output.getvalue().split('return "')[0]   # except timestamp
+
+
+def test_parse_options(create_parser):
+    parser = create_parser
+    detailed = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    assert parser.get_parse_options([CursorKind.TYPEDEF_DECL]) & detailed == 0     # macros aren't requested
+    assert parser.get_parse_options([CursorKind.MACRO_DEFINITION]) & detailed
+    assert parser.get_parse_options() & detailed
+    parser.keep_units()     # kept unit is reused for any kinds
+    assert parser.get_parse_options([CursorKind.TYPEDEF_DECL]) & detailed
+
+
+def test_memory_cache(tmp_path):
+    header = tmp_path / "header.h"
+    header.write_text("int a;")
+    cache = MemoryCache(dict(), ("args", ), validate=True)
+    cache.store(str(header), [], ["extracted"])
+    assert cache.load(str(header)) == ["extracted"]
+    header.write_text("int b;")
+    assert MemoryCache(cache._entries, ("args", ), validate=True).load(str(header)) is None  # contents changed
+
+
+def test_extraction_cache(tmp_path, monkeypatch):
+    source, header = tmp_path / "source.c", tmp_path / "header.h"
+    source.write_text('#include "header.h"')
+    header.write_text("int a;")
+
+    def get_cache(key_args=("args", )):
+        return ExtractionCache(str(tmp_path / "cache"), 1024 * 1024, key_args)  # files are hashed once per instance
+
+    def load(key_args=("args", )):
+        return get_cache(key_args).load(str(source))
+
+    get_cache().store(str(source), [str(header)], ["extracted"])
+    assert load() == ["extracted"]
+    assert load(("other args", )) is None
+    header.write_text("int b;")
+    assert load() is None                               # included file changed
+    get_cache().store(str(source), [str(header)], ["extracted"])
+    source.write_text('#include "header.h"\nint c;')
+    assert load() is None                               # parsed file changed
+    source.write_text('#include "header.h"')
+    assert load() == ["extracted"]
+    monkeypatch.setattr(ExtractionCache, "_version", ExtractionCache._version + 1)
+    assert load() is None                               # format of handled instances changed
+
+
+def test_directory_cache_eviction(tmp_path):
+    files = [tmp_path / "{}.c".format(name) for name in "abc"]
+    cache = ExtractionCache(str(tmp_path / "cache"), 0, ("args", ))
+    for mtime, file in enumerate(files):
+        file.write_text("int {};".format(file.stem))
+        cache.store(str(file), [], ["extracted"] * 100)
+        os.utime(cache.get_entry_path(str(file)), (mtime, mtime))
+    entry_size = os.path.getsize(cache.get_entry_path(str(files[0])))
+    os.utime(cache.get_entry_path(str(files[0])), (len(files), len(files)))     # the least recently used is the second
+    ExtractionCache(str(tmp_path / "cache"), 2 * entry_size, ("args", )).evict()
+    assert [os.path.exists(cache.get_entry_path(str(file))) for file in files] == [True, False, True]
+
+
+def test_memory_cache_eviction(tmp_path):
+    files = [str(tmp_path / "{}.h".format(name)) for name in "abc"]
+    entries = dict()
+    cache = MemoryCache(entries, ("args", ))
+    for file in files:
+        cache.store(file, [], ["extracted"] * 100)
+    entry_size = len(entries[cache.get_entry_key(files[0])][1])
+    cache.load(files[0])    # the least recently used is the second one now
+    MemoryCache(entries, ("args", ), max_size=2 * entry_size).evict()
+    assert cache.load(files[1]) is None
+    assert cache.load(files[0]) == cache.load(files[2]) == ["extracted"] * 100
+    assert list(cache.get_dependencies(files[1])) == [files[1]]     # known for stored entry though it is evicted
+
+
+def test_default_socket(tmp_path, monkeypatch):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+    directory = os.path.dirname(get_default_socket())
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o755)  # any user might create socket there
+    with pytest.raises(PermissionError):
+        get_default_socket()
+
+
+def test_served_requests(tmp_path):
+    (tmp_path / "settings.json").write_text(open("settings.json").read()
+                                            .replace('"./"', '"{}/"'.format(os.path.abspath(".")))
+                                            .replace('"generated.py"', '"{}"'.format(tmp_path / "generated.py")))
+    extracted, projects = dict(), dict()
+    outputs = list()
+    for _ in range(2):  # the second request reuses resolved project
+        assert generate_request(["--settings", str(tmp_path / "settings.json")], extracted, projects) == 0
+        outputs.append((tmp_path / "generated.py").read_text().rsplit("return", 1)[0])   # without generation time
+    assert len(projects) == 1
+    assert outputs[0] == outputs[1]
+
+
+@pytest.fixture
+def samples_project(tmp_path):
+    shutil.copytree("samples", tmp_path / "samples")
+    with open("settings.json", mode="r") as settings_file:
+        settings = json.load(settings_file)
+    settings["project"] = "{}/".format(tmp_path)
+    settings["output"] = str(tmp_path / "generated.py")
+    (tmp_path / "settings.json").write_text(json.dumps(settings))
+    return tmp_path
+
+
+def generate_samples(project, *args):
+    Kinds.reset()
+    parser = Parser(["--settings", str(project / "settings.json")] + list(args))
+    writer = Writer(parser.incremental)
+    traverse_ast(parser, writer, [CursorKind.TYPEDEF_DECL])
+    kinds = [kind for key in Kinds.cursorKinds.keys() if key != (CursorKind.TYPEDEF_DECL, ) for kind in key]
+    resolve_types(traverse_ast(parser, writer, kinds))
+    generate_wrapper(parser, writer)
+    output = (project / "generated.py").read_text()
+    return output.rsplit("return", 1)[0], writer     # without generation time
+
+
+@pytest.mark.parametrize("file, old, new", [
+    ("include/header.h", "#define MACRO_INT1_test 42", "#define MACRO_INT1_test 43"),
+    ("_source.c", "typedef int(callback_test*)(int, int);", "typedef int(callback_test*)(int, char);"),
+    ("_source.c", "    T_handler t;\n", "    T_handler t;\n    int extra_test;\n"),
+])
+def test_incremental_output(samples_project, file, old, new):
+    print()
+    generate_samples(samples_project, "--incremental")
+    unchanged, writer = generate_samples(samples_project, "--incremental")
+    assert writer._sections == writer._previousSections     # every section is reused
+
+    source = samples_project / "samples" / file
+    assert old in source.read_text()
+    source.write_text(source.read_text().replace(old, new))
+    incremental, _ = generate_samples(samples_project, "--incremental")
+    assert incremental != unchanged
+    assert incremental == generate_samples(samples_project)[0]
+
+
+def test_keep_paths(tmp_path, monkeypatch):
+    # declarations of kept header are generated, subtrees from system header are never walked
+    for directory, header in (("kept", "struct Kept_test { int value; };\n"),
+                              ("system", "struct System_test { int first; int second; };\n")):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "{}.h".format(directory)).write_text(header)
+    (tmp_path / "source.c").write_text('#include "kept.h"\n#include <system.h>\nstruct Source_test { int value; };\n')
+    (tmp_path / "settings.json").write_text(json.dumps({
+        "project": "{}/".format(tmp_path), "files": ["source.c"], "-Ipaths": ["kept"], "keepPaths": ["kept"],
+        "preprocessor": ["-isystem{}".format(tmp_path / "system")], "output": str(tmp_path / "generated.py")}))
+
+    walked = list()
+    walk_all = generator.walk
+
+    def walk_recorded(root, kinds=None, file_filter=None, skip=None):
+        for cursor, depth, parent in walk_all(root, None, file_filter, skip):
+            walked.append(cursor.location.file.name if cursor.location.file else None)
+            if kinds is None or cursor.kind in kinds:
+                yield cursor, depth, parent
+
+    monkeypatch.setattr(generator, "walk", walk_recorded)
+    profiler.enable()
+    try:
+        output = generate_samples(tmp_path)[0]
+        counters = profiler.report()["counters"]
+    finally:
+        profiler.reset()
+    assert "struct_Kept_test" in output and "struct_Source_test" in output
+    assert "System_test" not in output
+    assert any(file is not None and file.endswith("kept.h") for file in walked)
+    assert not any(file is not None and file.endswith("system.h") for file in walked)
+    assert counters["subtrees pruned"] > 0
+
+
+def test_parallel_output(samples_project):
+    def generate_units(jobs):
+        Kinds.reset()
+        parser = Parser(["--settings", str(samples_project / "settings.json"), "--jobs", str(jobs)])
+        writer = Writer(parser.incremental)
+        resolve_types(traverse_units(parser, writer))
+        generate_wrapper(parser, writer)
+        return (samples_project / "generated.py").read_text().rsplit("return", 1)[0]
+
+    sequential = generate_units(1)
+    assert sequential == generate_samples(samples_project)[0]
+    assert [generate_units(jobs) for jobs in (2, 2, 3)] == [sequential] * 3    # merged in order of files
+
+
+def test_merged_registration(samples_project):
+    Kinds.reset()
+    parser = Parser(["--settings", str(samples_project / "settings.json")])
+    resolve_types(traverse_units(parser, Writer()))     # handled in this process, registered on merge
+    for aliases in CommonTypeData.symbols.underlyings.values():
+        assert len(aliases) == len(set(aliases))        # every alias is registered once
+    assert CommonTypeData.symbols.underlyings["uint8_t"] == ["u8_test"]
+
+
+def test_parallel_profile(samples_project):
+    profiler.enable()
+    try:
+        parser = Parser(["--settings", str(samples_project / "settings.json"), "--jobs", "2"])
+        traverse_units(parser, Writer())
+        report, events = profiler.report(), profiler.get_measurements()["events"]
+    finally:
+        profiler.reset()
+    assert set(report["units"]) == set(parser.files)   # units are walked in worker processes only
+    assert report["counters"]["cursors visited"] > 0
+    assert os.getpid() not in {event["pid"] for event in events if event["cat"] == "unit"}
+
+
+def test_watch(tmp_path, monkeypatch):
+    # project of one listed file, output depends on header it includes
+    (tmp_path / "count.h").write_text("#define COUNT 4\n")
+    (tmp_path / "source.c").write_text('#include "count.h"\nstruct S_test { int values[COUNT]; };\n')
+    (tmp_path / "settings.json").write_text(json.dumps({"project": "{}/".format(tmp_path), "files": ["source.c"],
+                                                        "-Ipaths": [], "preprocessor": [],
+                                                        "output": str(tmp_path / "generated.py")}))
+    outputs = list()
+
+    def sleep(interval):
+        outputs.append((tmp_path / "generated.py").read_text())
+        if len(outputs) == 2:
+            raise KeyboardInterrupt     # the only way to stop watching
+        (tmp_path / "count.h").write_text("#define COUNT 8\n")
+
+    monkeypatch.setattr("time.sleep", sleep)
+    with pytest.raises(KeyboardInterrupt):
+        watch(Parser(["--settings", str(tmp_path / "settings.json"), "--watch", "0"]))
+    assert '("values", c_int32 * 4)' in outputs[0]
+    assert '("values", c_int32 * 8)' in outputs[1]      # regenerated after included header was changed
+
+
+def test_ast_cache(samples_project, monkeypatch):
+    parsed = list()
+    parse_source = Parser.parse_source
+    monkeypatch.setattr(Parser, "parse_source", lambda self, file, options: parsed.append(file) or parse_source(self, file, options))
+    args = ["--settings", str(samples_project / "settings.json"), "--ast-cache", str(samples_project / "ast")]
+
+    def parse_files():
+        parsed.clear()
+        parser = Parser(args)
+        for _ in parser.parse_next_file():
+            pass
+        return parser.files
+
+    files = parse_files()
+    assert parsed == files                                      # parsed from source and saved
+    assert len(list((samples_project / "ast").glob("*.ast"))) == len(files)
+    assert parse_files() == files and parsed == []              # loaded from ast cache
+
+    source = samples_project / "samples" / "_source.c"
+    source.write_text(source.read_text() + "\n#define MACRO_ADDED_test 1\n")
+    parse_files()
+    assert parsed == [str(source)]                              # saved header unit is still valid
+
+    header = samples_project / "samples" / "include" / "header.h"
+    header.write_text(header.read_text() + "\n#define MACRO_ADDED_test 1\n")
+    parse_files()
+    assert parsed == files                                      # header is included by source as well
@@ -9,16 +9,22 @@
 # TODO: implement OOP logic
 # TODO: split into modules
 # TODO: exceptions
-# TODO: autodetect source files order if both must be parsed and one is included by another
 # TODO: logging (module 'logging')
 
 
+import os
+import sys
+import io
 import argparse
 import json
+import threading
 import clang.cindex as cl
-from clang.cindex import TranslationUnit
+from clang.cindex import TranslationUnit, TokenGroup
 from clang.cindex import CursorKind
-from clang.cindex import TokenGroup
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'oop'))
+from modules.walker import walk     # common AST walker
+from modules.profiler import profiler
 
 
 # ---------------------------------------------------------------------- #
@@ -26,20 +32,69 @@ from clang.cindex import TokenGroup
 # ---------------------------------------------------------------------- #
 
 
-# handle current unit to find out if current cursor is from correct file
-currentUnitHandler = 0
-currentUnitSpelling = ""
+class Session:
+
+    # state of one generation: kinds handled in current unit and typedefs accumulated over all units
+    # every generate() starts from clean state, so session might be reused; generate() calls of one session
+    # are serialized, independent sessions (each with its own index) might generate from several threads at once
+
+    def __init__(self, index=None):
+        self.index = index      # created on the first generate() if not given
+        self.outputFile = None  # file to write to, from the last generated settings
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # handle current unit to find out if current cursor is from correct file
+        self.currentUnitHandler = 0
+        self.currentUnitSpelling = ""
+
+        # keep all handled kinds in convenient for generating code format
+        self.structures = {}  # "name"   :  {"name" : "type"}
+        self.enums = {}  # "name"   :  {"name" :  int  }
+        self.macros = {}  # "name"   :  "value"
+        self.functions = {}  # ("name", "type")  :  {"name" : "type"}
+        self.typedefs = {}  # "alias"  :  "underlying"
+
+        self.typedefsAccum = {}  # keep typedefs are declared in parsed and (!) generated file, but is used in another
+        self.typedefsReplaced = {}  # keep underlying types for the case when they are used despite typedef aliases
+        self.typedefsAfter = {}  # keep typedefs which are pointers to complete usertype
+
+    def generate(self, settings):
+        # settings file path or loaded settings -> text of generated wrapper
+        with self._lock:
+            self.reset()
+
+            # shared context for all files will be parsed
+            project_path, parse_files, parse_args, self.outputFile = get_settings(settings)
+            parse_opts = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD | TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+            if self.index is None:
+                self.index = cl.Index.create()
+
+            wrapper = io.StringIO()
+            generate_header(wrapper)
+
+            units = parse_ordered(self.index, project_path, parse_files, parse_args, parse_opts)
+            for current_file, translation_unit in units:      # TODO: exception
+                with profiler.span(current_file, "unit"):
+                    handle_unit(self, translation_unit)
+                    with profiler.span("generation"):
+                        generate_code(self, wrapper, current_file)
+                del translation_unit    # unit is disposed as soon as it is handled
+                self.currentUnitHandler = 0
+
+            # put all functions together
+            with profiler.span("generation"):
+                generate_functions(self, wrapper)
 
-# keep all handled kinds in convenient for generating code format
-structures = {}  # "name"   :  {"name" : "type"}
-enums = {}  # "name"   :  {"name" :  int  }
-macros = {}  # "name"   :  "value"
-functions = {}  # ("name", "type")  :  {"name" : "type"}
-typedefs = {}  # "alias"  :  "underlying"
+            self.reset()    # the last unit isn't referenced anymore
+            return wrapper.getvalue()
+
+
+def generate(settings, index=None):
+    # in-process generation: settings file path or loaded settings -> text of generated wrapper
+    return Session(index).generate(settings)
 
-typedefsAccum = {}  # keep typedefs are declared in parsed and (!) generated file, but is used in another
-typedefsReplaced = {}  # keep underlying types for the case when they are used despite typedef aliases
-typedefsAfter = {}  # keep typedefs which are pointers to complete usertype
 
 # cursor kinds will be handled
 cursorKinds = {
@@ -133,46 +188,41 @@ def print_cursor_info(cursor):
         print_cursor_location(cursor)
 
 
-def print_containers():
+def print_containers(session):
     # structures
-    global structures
     print("\n +-------------------- STRUCTURES --------------------+ ")
-    for name, fields in structures.items():
+    for name, fields in session.structures.items():
         print("\n    {:<0}".format(name))
         for fname, ftype in fields.items():
             print("       {:<24} {:<24}".format(ftype, fname))
     print()
 
     # enums
-    global enums
     print("\n +---------------------- ENUMS ------------------------+ ")
-    for name, constants in enums.items():
+    for name, constants in session.enums.items():
         print("\n    {:<0}".format(name))
         for cname, cvalue in constants.items():
             print("       {:<8} {}".format(cname, cvalue))
     print()
 
     # typedefs
-    global typedefs
     print("\n +--------------------- TYPEDEFS ----------------------+ ")
     print()
-    for alias, underlying in typedefs.items():
+    for alias, underlying in session.typedefs.items():
         print("    {:<14} {:<24}".format(alias, underlying))
     print()
 
     # macros
-    global macros
     print("\n +---------------------- MACROS -----------------------+ ")
     print()
-    for name, value in macros.items():
+    for name, value in session.macros.items():
         print("    {:<14} {:<24}".format(name, value))
     print()
 
     # functions
-    global functions
     print("\n +--------------------- FUNCTIONS ---------------------+ ")
     print()
-    for [fname, ftype], arguments in functions.items():
+    for [fname, ftype], arguments in session.functions.items():
         print("    _name_: {:<0}".format(fname))
         print("    _return_: {:<0}".format(ftype))
         print("    _arguments_: ")
@@ -193,13 +243,20 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--settings', dest="settpath", type=str, default='./settings.json',
                         help="path to settings file")
+    parser.add_argument('--profile', dest="profpath", type=str, nargs='?', const="profile.json", default=None,
+                        help="save timings of phases and units and counters to json report")
+    parser.add_argument('--profile-trace', dest="tracepath", type=str, default=None,
+                        help="with --profile, save phases and units as chrome trace events as well")
     args = parser.parse_args()
     return args
 
 
-def get_settings(sett_path):
-    settings_file = open(sett_path, mode="r")
-    settings_dict = json.load(settings_file)
+def get_settings(settings):
+    if isinstance(settings, dict):
+        settings_dict = settings
+    else:
+        with open(settings, mode="r") as settings_file:
+            settings_dict = json.load(settings_file)
 
     # root directory, files to parse
     settings = [settings_dict["project"], settings_dict["files"]]
@@ -208,7 +265,7 @@ def get_settings(sett_path):
     compile_args = []
     compile_args.extend(settings_dict["preprocessor"])
 
-    include_paths = settings_dict["-Ipaths"]
+    include_paths = list(settings_dict["-Ipaths"])     # given settings are left untouched
     for path in range(len(include_paths)):
         include_paths[path] = add_prefix(include_paths[path], "-I" + settings_dict["project"])
     compile_args.extend(include_paths)
@@ -218,13 +275,12 @@ def get_settings(sett_path):
     # file to write to
     settings.append(settings_dict["output"])
 
-    settings_file.close()
     return settings
 
 
-def is_from_given_file(cursor):
+def is_from_given_file(session, cursor):
     if cursor.location.file:
-        if cursor.location.file.name == currentUnitSpelling:
+        if cursor.location.file.name == session.currentUnitSpelling:
             return True
     return False
 
@@ -256,7 +312,7 @@ def is_array(string):
     return value, string
 
 
-def get_ctype(source_type):
+def get_ctype(session, source_type):
     temp = source_type
     ctype = ""
     known_type = False
@@ -282,27 +338,27 @@ def get_ctype(source_type):
         known_type = True
 
     # full enum type even if typedef was declared
-    elif source_type in typedefsReplaced.keys():
-        ctype = typedefsReplaced[source_type]
+    elif source_type in session.typedefsReplaced.keys():
+        ctype = session.typedefsReplaced[source_type]
         known_type = True
 
     # structure typedef
-    elif source_type in structures.keys():
+    elif source_type in session.structures.keys():
         ctype = source_type
         known_type = True
 
     # struct without typedef
-    elif source_type.replace("struct ", "struct_") in structures.keys():
+    elif source_type.replace("struct ", "struct_") in session.structures.keys():
         ctype = source_type.replace("struct ", "struct_")
         known_type = True
 
     # full sruct type even if typedef was declared
-    elif source_type.replace("struct ", "struct_") in typedefsReplaced.keys():
-        ctype = typedefsReplaced[source_type.replace("struct ", "struct_")]
+    elif source_type.replace("struct ", "struct_") in session.typedefsReplaced.keys():
+        ctype = session.typedefsReplaced[source_type.replace("struct ", "struct_")]
         known_type = True
 
     # typedef was declared in file parsed and (!) generated before
-    elif source_type in typedefsAccum.keys():
+    elif source_type in session.typedefsAccum.keys():
         ctype = source_type
         known_type = True
 
@@ -329,39 +385,36 @@ def get_ctype(source_type):
     return ctype
 
 
-def hanlde_typedefs():
-    global typedefs
-    global structures
-    global enums
-    for alias, underlying in typedefs.items():
+def hanlde_typedefs(session):
+    for alias, underlying in session.typedefs.items():
 
-        if underlying in enums.keys():
-            constants = enums[underlying]
-            enums.pop(underlying)
-            enums[alias] = constants
-            typedefs[alias] = 'c_int # ' + underlying
-            typedefsReplaced[underlying] = alias  # if full type naming will appear
+        if underlying in session.enums.keys():
+            constants = session.enums[underlying]
+            session.enums.pop(underlying)
+            session.enums[alias] = constants
+            session.typedefs[alias] = 'c_int # ' + underlying
+            session.typedefsReplaced[underlying] = alias  # if full type naming will appear
 
-        elif underlying.replace("struct ", "struct_") in structures.keys():
+        elif underlying.replace("struct ", "struct_") in session.structures.keys():
             key = underlying.replace("struct ", "struct_")
-            fields = structures[key]
-            structures.pop(key)
-            structures[alias] = fields
-            typedefsReplaced[key] = alias  # if full type naming will appear
+            fields = session.structures[key]
+            session.structures.pop(key)
+            session.structures[alias] = fields
+            session.typedefsReplaced[key] = alias  # if full type naming will appear
 
         elif underlying.find('(') != -1:
             open_brace = underlying.find('(')
             close_brace = underlying.find(')')
-            fun_type = get_ctype(underlying[:open_brace:].strip(' '))
+            fun_type = get_ctype(session, underlying[:open_brace:].strip(' '))
             args_list = underlying[close_brace + 2: -1: 1].split(", ")
-            args = (', ' + ', '.join([get_ctype(arg) for arg in args_list])) \
+            args = (', ' + ', '.join([get_ctype(session, arg) for arg in args_list])) \
                 if args_list[0] != "" else ""  # no args in function pointer
             c_func = "CFUNCTYPE(" + fun_type + args + ")"
-            typedefs[alias] = c_func
+            session.typedefs[alias] = c_func
 
         else:
-            underlying = get_ctype(underlying)
-            typedefs[alias] = underlying
+            underlying = get_ctype(session, underlying)
+            session.typedefs[alias] = underlying
 
 
 # ---------------------------------------------------------------------- #
@@ -375,8 +428,7 @@ def parse_field(cursor):
     return {name: source_type}
 
 
-def parse_structure(cursor):
-    global structures
+def parse_structure(session, cursor):
     name = "struct_" + cursor.displayname
     fields = {}
     for field in cursor.get_children():
@@ -389,7 +441,7 @@ def parse_structure(cursor):
         # debug
         # print_cursor_info(field)
         fields.update(parse_field(field))
-    structures[name] = fields
+    session.structures[name] = fields
 
 
 def parse_const(cursor):
@@ -398,37 +450,34 @@ def parse_const(cursor):
     return {name: value}
 
 
-def parse_enum(cursor):
-    global enums
+def parse_enum(session, cursor):
     name = "enum " + cursor.displayname
     children = {}
     for const in cursor.get_children():
         if not (const.kind == CursorKind.ENUM_CONSTANT_DECL):
             print("parse_enum(), unexpected const kind")    # TODO: exception
         children.update(parse_const(const))
-    enums[name] = children
+    session.enums[name] = children
 
 
-def parse_typedef(cursor):
-    global typedefs
+def parse_typedef(session, cursor):
     alias = cursor.type.spelling
     underlying = cursor.underlying_typedef_type.spelling
-    typedefs.update({alias: underlying})
+    session.typedefs.update({alias: underlying})
 
 
-def parse_macros(cursor):
-    global macros
+def parse_macros(session, cursor):
     tokens = []
-    for token in TokenGroup.get_tokens(currentUnitHandler, cursor.extent):
+    for token in TokenGroup.get_tokens(session.currentUnitHandler, cursor.extent):
         tokens.append(token.spelling)
     if len(tokens) == 2:
         name = tokens[0]
         value = tokens[1]
-        macros.update({name: value})
+        session.macros.update({name: value})
     if len(tokens) == 4 and tokens[1] == '(' and tokens[3] == ')' and tokens[2] != "...":
         name = tokens[0]
         value = tokens[2]
-        macros.update({name: value})
+        session.macros.update({name: value})
 
 
 def parse_argument(cursor):
@@ -437,15 +486,14 @@ def parse_argument(cursor):
     return {name: source_type}
 
 
-def parse_functions(cursor):
-    global functions
+def parse_functions(session, cursor):
     name = cursor.displayname.partition("(")[0]
     if name[:5:] != "ENUM_" and name[:4:] != "SDK_" and name[-1:-9:-1][::-1] != "ToString":
         source_type = cursor.type.get_result().spelling
         arguments = {}
         for arg in cursor.get_arguments():
             arguments.update(parse_argument(arg))
-        functions[(name, source_type)] = arguments
+        session.functions[(name, source_type)] = arguments
 
 
 # ---------------------------------------------------------------------- #
@@ -459,66 +507,59 @@ def generate_header(wrapper):
     wrapper.write("from ctypes import *\n")
 
 
-def generate_typedefs_after(wrapper):
-    global typedefsAfter
-    if len(typedefsAfter):
+def generate_typedefs_after(session, wrapper):
+    if len(session.typedefsAfter):
         wrapper.write("\n# _typedefs_after_ = \n")
-    for alias, underlying in typedefsAfter.items():
+    for alias, underlying in session.typedefsAfter.items():
         wrapper.write("{} = {} \n".format(alias, underlying))
-    typedefsAfter = {}
+    session.typedefsAfter = {}
 
 
-def generate_typedefs(wrapper):
-    hanlde_typedefs()  # use parsed data to effect other types
-    global typedefs
-    global typedefsAccum
-    global typedefsAfter
-    if len(typedefs):
+def generate_typedefs(session, wrapper):
+    hanlde_typedefs(session)  # use parsed data to effect other types
+    if len(session.typedefs):
         wrapper.write("\n# _typedefs_ = \n")
-    for alias, underlying in typedefs.items():
+    for alias, underlying in session.typedefs.items():
         if underlying[:16:] != "POINTER(POINTER(" and underlying[
                                                       :15:] == "POINTER(struct_":  # replace handlers with typedefs
             close_brace = underlying.find(')')
             handler_for = underlying[8:close_brace]
-            if handler_for in typedefsReplaced.keys():
-                handler_for = typedefsReplaced[handler_for]
+            if handler_for in session.typedefsReplaced.keys():
+                handler_for = session.typedefsReplaced[handler_for]
             wrapper.write("{} = c_void_p  # handler for '{}'\n".format(alias, handler_for))
         elif underlying.find("CFUNCTYPE") != -1 or underlying.find("c_") != -1:
             wrapper.write("{} = {} \n".format(alias, underlying))
         elif underlying.find("POINTER") != -1:
             temp = underlying.replace("POINTER(", "").replace(")", "")
-            typedefsAfter[alias] = underlying if temp not in typesMapping.keys() else typesMapping[temp]
+            session.typedefsAfter[alias] = underlying if temp not in typesMapping.keys() else typesMapping[temp]
         else:
             wrapper.write("{} = \"{}\" \n".format(alias, underlying))
 
-    typedefsAccum = {**typedefsAccum, **typedefs}
-    typedefs = {}
+    session.typedefsAccum = {**session.typedefsAccum, **session.typedefs}
+    session.typedefs = {}
 
 
-def generate_macros(wrapper):
-    global macros
-    if len(macros):
+def generate_macros(session, wrapper):
+    if len(session.macros):
         wrapper.write("\n# _macros_ = \n")
-    for name, value in macros.items():
+    for name, value in session.macros.items():
         value = "c_int(" + value + ")" if value.isdigit() else value
         wrapper.write("{} = {} \n".format(name, value))
 
-    macros = {}
+    session.macros = {}
 
 
-def generate_enums(wrapper):
-    global enums
-    for name, consts in enums.items():
+def generate_enums(session, wrapper):
+    for name, consts in session.enums.items():
         wrapper.write("\n# {} \n".format(name))
         for cname, cvalue in consts.items():
             wrapper.write("{} = c_int({}) \n".format(cname, cvalue))
 
-    enums = {}
+    session.enums = {}
 
 
-def generate_structs(wrapper):
-    global structures
-    for structName, fields in structures.items():
+def generate_structs(session, wrapper):
+    for structName, fields in session.structures.items():
         incomplete_type = "# incomplete type, pointers to type replaced with 'c_void_p'" if not len(fields) else ""
         wrapper.write("\nclass {}(Structure):  {}\n".format(structName, incomplete_type))
         wrapper.write("    _fields_ = [")
@@ -527,7 +568,7 @@ def generate_structs(wrapper):
         ftypes = list(fields.values())
 
         for i in range(len(fnames)):
-            field_type = get_ctype(ftypes[i])
+            field_type = get_ctype(session, ftypes[i])
             this_struct = False
 
             # pointer to intelf
@@ -536,8 +577,8 @@ def generate_structs(wrapper):
                 this_struct = True
 
             # alias for pointer to itself, alias declared for struct without typedef or before struct typedef
-            if field_type in typedefsAccum.keys():
-                underlying = typedefsAccum[field_type]
+            if field_type in session.typedefsAccum.keys():
+                underlying = session.typedefsAccum[field_type]
 
                 if underlying == "POINTER(" + structName + ")":
                     pass
@@ -546,8 +587,8 @@ def generate_structs(wrapper):
 
                 else:
                     temp = underlying.replace("POINTER(", "").replace(")", "")
-                    if temp in typedefsReplaced.keys():
-                        if typedefsReplaced[temp] == structName:
+                    if temp in session.typedefsReplaced.keys():
+                        if session.typedefsReplaced[temp] == structName:
                             # field_type = "c_void_p"
                             this_struct = True
 
@@ -566,7 +607,7 @@ def generate_structs(wrapper):
 
         wrapper.write("\n\t]\n")
 
-    structures = {}
+    session.structures = {}
 
 
 def generate_functions_class_begin(wrapper):
@@ -616,24 +657,23 @@ def generate_functions_class_end(wrapper):
 """)
 
 
-def generate_functions(wrapper):
+def generate_functions(session, wrapper):
     print(f"Processing all units functions")
-    global functions
     generate_functions_class_begin(wrapper)
-    for key, value in functions.items():
+    for key, value in session.functions.items():
 
         wrapper.write("\n\t\t\tself.{} = lib.{}\n".format(key[0], key[0]))
-        wrapper.write("\t\t\tself.{}.restype = {}\n".format(key[0], get_ctype(key[1])))
+        wrapper.write("\t\t\tself.{}.restype = {}\n".format(key[0], get_ctype(session, key[1])))
         wrapper.write("\t\t\tself.{}.argtypes = [".format(key[0]))
         args = list(value.values())
 
         for i in range(len(args) - 1):
-            wrapper.write("{}, ".format(get_ctype(args[i])))
+            wrapper.write("{}, ".format(get_ctype(session, args[i])))
         if len(args):
-            wrapper.write("{}".format(get_ctype(args[len(args) - 1])))
+            wrapper.write("{}".format(get_ctype(session, args[len(args) - 1])))
         wrapper.write("]\n")
     generate_functions_class_end(wrapper)
-    functions = {}
+    session.functions = {}
 
 
 # ---------------------------------------------------------------------- #
@@ -641,71 +681,90 @@ def generate_functions(wrapper):
 # ---------------------------------------------------------------------- #
 
 
-def visitor_function(parent):
-    for cursor in parent.get_children():
+def visitor_function(session, parent):
+    # top level declaration from another file (was #include'd): skip the whole subtree, it is handled in its own unit
+    skip = lambda cursor, depth: depth == 0 and not is_from_given_file(session, cursor)
 
-        if is_from_given_file(cursor) and is_appropriate_kind(cursor):
+    for cursor, _, _ in walk(parent, cursorKinds.keys(), skip=skip):
+
+        if is_from_given_file(session, cursor):
 
             if cursor.kind == CursorKind.STRUCT_DECL:
-                parse_structure(cursor)
+                parse_structure(session, cursor)
             if cursor.kind == CursorKind.ENUM_DECL:
-                parse_enum(cursor)
+                parse_enum(session, cursor)
             if cursor.kind == CursorKind.TYPEDEF_DECL:
-                parse_typedef(cursor)
+                parse_typedef(session, cursor)
             if cursor.kind == CursorKind.MACRO_DEFINITION:
-                parse_macros(cursor)
+                parse_macros(session, cursor)
             if cursor.kind == CursorKind.FUNCTION_DECL:
-                parse_functions(cursor)
+                parse_functions(session, cursor)
+
+        else:
+            profiler.count("cursors rejected")
+
+
+def parse_ordered(index, project_path, files, parse_args, parse_opts):
+    # every listed file is parsed once, units are given in order: included files go before files which include them
+    # unit waits only while listed files it includes are parsed and handled, so one unit per nesting level is alive
+    listed = {os.path.abspath(project_path + file): file for file in files}
+    visited = set()
 
-        # recursion
-        visitor_function(cursor)
+    def visit(file):
+        if file in visited:     # already handled or #include'd cyclically
+            return
+        visited.add(file)
+        with profiler.span("parse"):
+            translation_unit = index.parse(project_path + file, args=parse_args, options=parse_opts)
+        names = {os.path.abspath(inclusion.include.name) for inclusion in translation_unit.get_includes()}
+        for name, other in listed.items():  # in order they are listed
+            if name in names and other != file:
+                yield from visit(other)
+        yield file, translation_unit
 
+    for file in files:
+        yield from visit(file)
 
-def parse_file(index, current_file, parse_args, parse_opts):
-    translation_unit = index.parse(current_file, args=parse_args, options=parse_opts)
+
+def handle_unit(session, translation_unit):
     print(f"Processing unit: {translation_unit.spelling}")
 
-    global currentUnitHandler
-    global currentUnitSpelling
-    currentUnitHandler = translation_unit
-    currentUnitSpelling = translation_unit.spelling
+    session.currentUnitHandler = translation_unit
+    session.currentUnitSpelling = translation_unit.spelling
 
-    visitor_function(translation_unit.cursor)  # start with the root cursor
+    with profiler.span("traversal"):
+        visitor_function(session, translation_unit.cursor)  # start with the root cursor
 
 
-def generate_code(wrapper, current_file):
+def generate_code(session, wrapper, current_file):
     # info about file
     wrapper.write("\n")
     wrapper.write("# +----------------------------------------------------------------------+\n")
     wrapper.write("# +    {:<65} +\n".format(current_file))
     wrapper.write("# +----------------------------------------------------------------------+\n")
 
-    generate_typedefs(wrapper)
-    generate_macros(wrapper)
-    generate_enums(wrapper)
-    generate_structs(wrapper)
-    generate_typedefs_after(wrapper)
+    generate_typedefs(session, wrapper)
+    generate_macros(session, wrapper)
+    generate_enums(session, wrapper)
+    generate_structs(session, wrapper)
+    generate_typedefs_after(session, wrapper)
 
 
 def main():
     args = get_args()
+    if args.profpath is not None:
+        profiler.enable()
 
-    # shared context for all files will be parsed
-    project_path, parse_files, parse_args, output_file = get_settings(args.settpath)
-    parse_opts = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD | TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
-    index = cl.Index.create()
+    session = Session()
+    output = session.generate(args.settpath)
 
     # output wrapper file
-    wrapper = open(output_file, mode="w")
-    generate_header(wrapper)
-
-    for current_file in parse_files:      # TODO: exception
-        parse_file(index, project_path + current_file, parse_args, parse_opts)
-        generate_code(wrapper, current_file)
+    with open(session.outputFile, mode="w") as wrapper:
+        wrapper.write(output)
 
-    # put all functions together
-    generate_functions(wrapper)
-    wrapper.close()
+    if args.profpath is not None:
+        profiler.count("bytes written", os.path.getsize(session.outputFile))
+        profiler.save(args.profpath, args.tracepath)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+# https://pytest-docs-ru.readthedocs.io/ru/latest/contents.html
+
+
+import sys
+sys.path.append('..')
+
+
+import threading
+import clang.cindex as cl
+from generator import Session, parse_ordered
+from modules.profiler import profiler
+from clang.cindex import TranslationUnit
+
+
+# +------------------------------------------------------+
+# +     TESTS                                            +
+# +------------------------------------------------------+
+
+
+def get_parsed(project, files):
+    index = cl.Index.create()
+    parsed = list()
+    parse = index.parse
+    index.parse = lambda path, **kwargs: parsed.append(path) or parse(path, **kwargs)
+    ordered = [file for file, _ in parse_ordered(index, "{}/".format(project), files, [],
+                                                 TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)]
+    return ordered, parsed
+
+
+def test_parse_ordered(tmp_path):
+    (tmp_path / "common.h").write_text("typedef int common_t;\n")
+    (tmp_path / "api.h").write_text('#include "common.h"\ncommon_t api(void);\n')
+    (tmp_path / "impl.c").write_text('#include "api.h"\ncommon_t api(void) { return 0; }\n')
+    (tmp_path / "other.c").write_text("int other;\n")
+    ordered, parsed = get_parsed(tmp_path, ["impl.c", "other.c", "api.h", "common.h"])
+    assert ordered == ["common.h", "api.h", "impl.c", "other.c"]
+    assert sorted(parsed) == sorted("{}/{}".format(tmp_path, file) for file in ordered)     # every file once
+
+
+def test_parse_ordered_cyclic(tmp_path):
+    (tmp_path / "a.h").write_text('#ifndef A\n#define A\n#include "b.h"\n#endif\n')
+    (tmp_path / "b.h").write_text('#ifndef B\n#define B\n#include "a.h"\n#endif\n')
+    ordered, parsed = get_parsed(tmp_path, ["a.h", "b.h"])
+    assert ordered == ["b.h", "a.h"]    # the first listed one goes after what it includes
+    assert len(parsed) == 2
+
+
+def get_settings(project):
+    (project / "common.h").write_text("#define COMMON_test 1\ntypedef int common_t;\nstruct Common_test { common_t value; };\n")
+    (project / "api.h").write_text('#include "common.h"\nenum Api_test { API_test = 2 };\ncommon_t api_test(int);\n')
+    return {"project": "{}/".format(project), "files": ["api.h", "common.h"], "-Ipaths": [], "preprocessor": [],
+            "output": str(project / "generated.py")}
+
+
+def test_session_repeated(tmp_path):
+    settings = get_settings(tmp_path)
+    session = Session()
+    first = session.generate(settings)
+    assert "Common_test" in first and "api_test" in first
+    assert session.generate(settings) == first      # every generation starts from clean state
+
+
+def test_session_threads(tmp_path):
+    settings = get_settings(tmp_path)
+    expected = Session().generate(settings)
+    shared = Session()
+    sessions = [Session(), Session(), shared, shared]   # independent ones run at once, shared one is serialized
+    outputs = [None] * len(sessions)
+
+    def generate(number):
+        outputs[number] = sessions[number].generate(settings)
+
+    profiler.enable()
+    try:
+        threads = [threading.Thread(target=generate, args=(number, )) for number in range(len(sessions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        units = profiler.report()["units"]
+    finally:
+        profiler.reset()
+    assert outputs == [expected] * len(sessions)
+    assert set(units) == {"api.h", "common.h"}      # measurements of all threads are summed up